@@ -0,0 +1,170 @@
+"""
+Requests per second of `GET /task` and `POST /task`, through the whole middleware stack.
+
+The app is called over ASGI in-process, with the database and the pixels API left out: the
+connection pool is a no-op, token checks accept every user and the canvas is preset so that
+every submission verifies straight away. Throughput is measured in CPU time of this process,
+which keeps the numbers comparable on a busy machine.
+
+Run this from the repository root, e.g. `poetry run task bench`. To compare two revisions,
+check each of them out into a `git worktree`, copy this directory over if it's missing there,
+and run it in both with the same `--users` and `--rounds`.
+"""
+import argparse
+import asyncio
+import os
+import time
+from array import array
+from typing import Dict, List, Tuple
+
+# These are required by `rickchurch.constants`, none of them are used for anything here
+for name, value in {
+    "BASE_URL": "http://localhost",
+    "CLIENT_ID": "0",
+    "CLIENT_SECRET": "benchmark",
+    "OAUTH_REDIRECT_URL": "http://localhost/oauth_callback",
+    "JWT_SECRET": "benchmark",
+    "DATABASE_URL": "postgres://benchmark@localhost/benchmark",
+    "PIXELS_API_TOKEN": "benchmark",
+}.items():
+    os.environ.setdefault(name, value)
+
+import pydispix  # noqa: E402 - these need the environment variables above
+
+from rickchurch import church, constants, ratelimit, tasks  # noqa: E402
+from rickchurch.auth import AuthResult, AuthState, TokenData, make_user_token  # noqa: E402
+
+CANVAS_SIZE = 1000
+
+
+class NoConnection:
+    """Stands in for a database connection, the task endpoints don't query the database."""
+
+    def transaction(self) -> "NoConnection":
+        return self
+
+    async def __aenter__(self) -> "NoConnection":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+class NoPool:
+    """Stands in for `constants.DB_POOL`."""
+
+    async def acquire(self) -> NoConnection:
+        return NoConnection()
+
+    async def release(self, connection: NoConnection) -> None:
+        pass
+
+
+async def check_token(token: TokenData, db_conn: NoConnection) -> AuthResult:
+    return AuthResult(AuthState.USER, token.user_id)
+
+
+def setup(users: int) -> List[bytes]:
+    """Prepare the app for the benchmark, return an authorization header for every user."""
+    constants.DB_POOL = NoPool()
+    church.check_token = check_token  # type: ignore - the middleware looks this up on every request
+
+    # Nothing should get rejected or expire while we're measuring
+    for limiter in ratelimit.route_limiters.values():
+        limiter.rate = 1e9
+        limiter.burst = users
+    constants.task_pending_delay = constants.task_lease_min = constants.task_lease_max = 3600
+    constants.max_concurrent_verifications = users
+
+    # Every pixel of the project is (0, 0, 0) on the canvas fetched long ago, and (1, 1, 1) on the current one
+    pixels = CANVAS_SIZE * CANVAS_SIZE
+    tasks.free_pixels = {
+        "benchmark": tasks.FreePixels("benchmark", CANVAS_SIZE, CANVAS_SIZE, b"\x01" * pixels * 3, array("I"))
+    }
+    tasks.canvas = pydispix.Canvas((CANVAS_SIZE, CANVAS_SIZE), b"\x01" * pixels * 3)
+    tasks.update_time = float("inf")
+
+    return [f"Bearer {make_user_token(user_id)[0]}".encode() for user_id in range(users)]
+
+
+async def request(method: str, path: str, authorization: bytes, body: bytes = b"") -> Tuple[int, bytes]:
+    """Make a request to the app over ASGI, return the status code and the body of the response."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "server": ("localhost", 80),
+        "client": ("localhost", 1234),
+        "headers": [
+            (b"authorization", authorization),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    received = False
+    response: Dict[str, object] = {"body": b""}
+
+    async def receive() -> dict:
+        nonlocal received
+        if received:
+            # Nothing else is coming, like on a connection which stays open
+            await asyncio.Event().wait()
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message: dict) -> None:
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        else:
+            response["body"] += message.get("body", b"")  # type: ignore - this is bytes
+
+    await church.app(scope, receive, send)
+    return response["status"], response["body"]  # type: ignore - these are set by `send`
+
+
+async def run(users: int, rounds: int) -> None:
+    authorizations = setup(users)
+    get_rates, post_rates = [], []
+
+    for _ in range(rounds):
+        tasks.free_pixels["benchmark"].indices = array("I", range(CANVAS_SIZE * CANVAS_SIZE))
+
+        bodies = []
+        start = time.process_time()
+        for authorization in authorizations:
+            status, body = await request("GET", "/task", authorization)
+            if status != 200:
+                raise RuntimeError(f"GET /task failed with {status}: {body!r}")
+            bodies.append(body)
+        get_rates.append(users / (time.process_time() - start))
+
+        start = time.process_time()
+        for authorization, body in zip(authorizations, bodies):
+            status, response_body = await request("POST", "/task", authorization, body)
+            if status != 200:
+                raise RuntimeError(f"POST /task failed with {status}: {response_body!r}")
+        post_rates.append(users / (time.process_time() - start))
+
+    get_rates.sort()
+    post_rates.sort()
+    print(f"{users} users, {rounds} rounds (requests per CPU second, median / best)")
+    print(f"GET /task:  {get_rates[rounds // 2]:.0f} / {get_rates[-1]:.0f}")
+    print(f"POST /task: {post_rates[rounds // 2]:.0f} / {post_rates[-1]:.0f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=3000, help="requests per round, one per user")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
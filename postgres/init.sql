@@ -16,3 +16,21 @@ CREATE TABLE IF NOT EXISTS public.projects (
     base64_image text NOT NULL,
     CONSTRAINT projects_pk PRIMARY KEY (project_name)
 );
+
+CREATE TABLE IF NOT EXISTS public.task_completions (
+    user_id int8 NOT NULL,
+    position_x int4 NOT NULL,
+    position_y int4 NOT NULL,
+    rgb text NOT NULL,
+    project_name text NOT NULL,
+    completed_at timestamptz NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS task_completions_user_idx ON public.task_completions (user_id);
+
+CREATE TABLE IF NOT EXISTS public.auto_join_jobs (
+    user_id int8 NOT NULL,
+    access_token text NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    CONSTRAINT auto_join_jobs_pk PRIMARY KEY (user_id)
+);
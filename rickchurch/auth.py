@@ -1,13 +1,14 @@
 import enum
 import secrets
-from typing import NamedTuple, Optional, Tuple
+from typing import NamedTuple, Optional, Tuple, Union
 
 import asyncpg
 import fastapi
 from fastapi.security.utils import get_authorization_scheme_param
 from jose import JWTError, jwt
 
-from rickchurch import constants
+from rickchurch import constants, database
+from rickchurch.tracing import span
 
 
 class AuthState(enum.Enum):
@@ -60,8 +61,15 @@ class AuthResult(NamedTuple):
         self.state.raise_unless_mod()
 
 
-async def authorized(authorization: Optional[str], asyncpg_conn: asyncpg.Connection) -> AuthResult:
-    """Attempt to authorize the user given a token and a database connection."""
+class TokenData(NamedTuple):
+    """The data stored in a user's token, it's only trusted once checked against the database."""
+
+    user_id: int
+    salt: str
+
+
+def decode_token(authorization: Optional[str]) -> Union[AuthResult, TokenData]:
+    """Decode the token from an Authorization header, without touching the database."""
     if authorization is None:
         return AuthResult(AuthState.NO_TOKEN, None)
 
@@ -70,23 +78,26 @@ async def authorized(authorization: Optional[str], asyncpg_conn: asyncpg.Connect
         return AuthResult(AuthState.BAD_HEADER, None)
 
     try:
-        token_data = jwt.decode(token, constants.jwt_secret)
+        with span("auth.jwt"):
+            token_data = jwt.decode(token, constants.jwt_secret)
     except JWTError:
         return AuthResult(AuthState.INVALID_TOKEN, None)
 
-    user_id = token_data["id"]
-    token_salt = token_data["salt"]
-    user_state = await asyncpg_conn.fetchrow(
-        "SELECT is_banned, is_mod, key_salt FROM users WHERE user_id = $1;", int(user_id)
-    )
-    if user_state is None or user_state["key_salt"] != token_salt:
+    return TokenData(int(token_data["id"]), token_data["salt"])
+
+
+async def check_token(token: TokenData, asyncpg_conn: asyncpg.Connection) -> AuthResult:
+    """Check a decoded token against the user's state in the database."""
+    with span("auth.query"):
+        user_state = await database.fetch_user_state(asyncpg_conn, token.user_id)
+    if user_state is None or user_state["key_salt"] != token.salt:
         return AuthResult(AuthState.INVALID_TOKEN, None)
     elif user_state["is_banned"]:
-        return AuthResult(AuthState.BANNED, int(user_id))
+        return AuthResult(AuthState.BANNED, token.user_id)
     elif user_state["is_mod"]:
-        return AuthResult(AuthState.MODERATOR, int(user_id))
+        return AuthResult(AuthState.MODERATOR, token.user_id)
     else:
-        return AuthResult(AuthState.USER, int(user_id))
+        return AuthResult(AuthState.USER, token.user_id)
 
 
 def make_user_token(user_id: int) -> Tuple[str, str]:
@@ -101,22 +112,6 @@ def make_user_token(user_id: int) -> Tuple[str, str]:
     return jwt.encode(jwt_data, constants.jwt_secret, algorithm="HS256"), token_salt
 
 
-async def reset_user_token(user_id: int, asyncpg_conn: asyncpg.Connection) -> str:
-    """Regenerate the token of an existing user and invalidate the old one"""
-
-    # Returns `None` if user doesn't exist and `False` if they aren't banned
-    is_banned = await asyncpg_conn.fetchval("SELECT is_banned FROM users WHERE user_id = $1", user_id)
-    if is_banned:
-        raise PermissionError
-
-    token, salt = make_user_token(user_id)
-
-    async with asyncpg_conn.transaction():
-        await asyncpg_conn.execute("UPDATE users SET key_salt=$1 WHERE user_id=$2", salt, user_id)
-
-    return token
-
-
 async def add_user(user: dict, db_conn: asyncpg.Connection) -> str:
     """
     Add a new church user. If given member already exists,
@@ -127,21 +122,9 @@ async def add_user(user: dict, db_conn: asyncpg.Connection) -> str:
     user_name = f"{user['username']}#{user['discriminator']}"  # Use the username#discriminator from discord
     user_id = int(user["id"])  # User id (snowflake) from discord
 
-    async with db_conn.transaction():
-        user_data = await db_conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-
-    if user_data is not None:
-        # The user already exists, only reset his token
-        return await reset_user_token(user_id, db_conn)
-
     token, salt = make_user_token(user_id)
-    async with db_conn.transaction():
-        # fmt: off
-        await db_conn.execute(
-            """INSERT INTO users (user_id, user_name, key_salt, is_mod,
-            is_banned, projects_complete) VALUES ($1, $2, $3, $4, $5, $6)""",
-            user_id, user_name, salt, False, False, 0
-        )
-        # fmt: on
+    if not await database.upsert_user(db_conn, user_id, user_name, salt):
+        # The user already exists and is banned, his token wasn't reset
+        raise PermissionError
 
     return token
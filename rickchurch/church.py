@@ -1,20 +1,29 @@
 import asyncio
 import logging
-from typing import Any, Callable, Dict, List, Optional
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import fastapi
 import httpx
 import pydispix
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import RedirectResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from rickchurch import constants, tasks
-from rickchurch.auth import add_user, authorized
-from rickchurch.log import setup_logging
-from rickchurch.models import Message, Project, ProjectDetails, Task, User
-from rickchurch.utils import fetch_projects, get_oauth_user
+from rickchurch import constants, database, ratelimit, responses, stats, tasks
+from rickchurch.auth import AuthResult, AuthState, add_user, check_token, decode_token
+from rickchurch.contributions import recorder
+from rickchurch.history import canvas_history
+from rickchurch.jobs import auto_join_queue
+from rickchurch.log import hot_path_logger, request_id_var, setup_logging, stop_logging, user_id_var
+from rickchurch.models import (
+    AdmissionStats, BulkModerationResult, CanvasHistoryStats, LeaderboardEntry, LeaseStats, Message, Project,
+    ProjectDetails, ProjectProgress, Task, TaskLease, User
+)
+from rickchurch.shared_canvas import shared_canvas
+from rickchurch.tracing import Trace, current_trace, profile_event_loop, setup_trace_export, span
+from rickchurch.utils import get_oauth_user, make_discord_client
 
 logger = logging.getLogger("rickchurch")
 app = fastapi.FastAPI(docs_url=None, redoc_url=None)
@@ -65,12 +74,25 @@ app.openapi = custom_openapi
 @app.on_event("startup")
 async def startup() -> None:
     """Create asyncpg connection pool on startup and setup logging."""
-    app.state.httpx_client = httpx.AsyncClient()
-    setup_logging(constants.log_level)
+    app.state.httpx_client = make_discord_client()
+    setup_logging(constants.log_level, constants.log_format, constants.log_hot_path_rate)
+    if constants.trace_export_path:
+        setup_trace_export(
+            constants.trace_export_path, constants.trace_export_max_bytes, constants.trace_export_backups
+        )
 
     # Initialize DB connection
     await constants.DB_POOL
 
+    # Start writing completed tasks to the database in the background
+    await recorder.start()
+
+    if constants.enable_auto_join:
+        await auto_join_queue.start(app.state.httpx_client)
+
+    if shared_canvas is not None:
+        shared_canvas.attach()
+
     # Start refreshing tasks
     asyncio.create_task(tasks.reload_loop())
 
@@ -78,19 +100,82 @@ async def startup() -> None:
 @app.on_event("shutdown")
 async def shutdown() -> None:
     """Close down the app."""
+    await auto_join_queue.stop()
     await app.state.httpx_client.aclose()
+    # Flush buffered contributions while the pool is still open
+    await recorder.stop()
     await constants.DB_POOL.close()
+    if shared_canvas is not None:
+        shared_canvas.close()
+    stop_logging()
+
+
+# These don't use the request's database connection or auth, so they don't hold a connection from the pool
+# for the whole request. `/oauth_callback` waits on discord, it only acquires a connection for its writes.
+NO_DB_PATHS = {"/", "/docs", "/info", "/authorize", "/oauth_callback", "/show_token", "/openapi.json"}
+# These only need the database to check the token, the connection is released before their (slow) handlers run
+AUTH_ONLY_PATHS = {"/mods/profile"}
 
 
 @app.middleware("http")
 async def setup_data(request: fastapi.Request, callnext: Callable) -> fastapi.Response:
     """Get a connection from the pool and a canvas reference for this request."""
-    async with constants.DB_POOL.acquire() as db_connection:
-        request.state.db_conn = db_connection
-        request.state.auth = await authorized(request.headers.get("Authorization"), db_connection)
-        response = await callnext(request)
-    request.state.db_conn = None
-    request.state.db_client = None
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    trace = Trace(f"{request.method} {request.url.path}")
+    current_trace.set(trace)
+
+    # Admission control runs before anything touches the database, the token
+    # is only decoded here, it will be checked against the database below
+    token = decode_token(request.headers.get("Authorization"))
+    if not isinstance(token, AuthResult):
+        retry_after = ratelimit.admit(request.method, request.url.path, token.user_id)
+        if retry_after is not None:
+            hot_path_logger.info("Rate limited %s %s", request.method, request.url.path)
+            return JSONResponse(
+                {"detail": "You're making too many requests, slow down."},
+                status_code=429,
+                headers={"Retry-After": str(retry_after), "X-Request-ID": request_id},
+            )
+
+    if request.url.path in NO_DB_PATHS or request.url.path.startswith("/static/"):
+        with span("handler"):
+            response = await callnext(request)
+    else:
+        with span("pool.acquire"):
+            db_connection = await constants.DB_POOL.acquire()
+        try:
+            request.state.db_conn = db_connection
+            if isinstance(token, AuthResult):
+                auth = token
+            else:
+                with span("auth"):
+                    auth = await check_token(token, db_connection)
+            request.state.auth = auth
+            user_id_var.set(auth.user_id)
+            if not auth and auth.state is not AuthState.NO_TOKEN:
+                hot_path_logger.info("Failed authorization on %s: %s", request.url.path, auth.state.name)
+
+            if request.url.path in AUTH_ONLY_PATHS:
+                request.state.db_conn = None
+                released, db_connection = db_connection, None
+                await constants.DB_POOL.release(released)
+
+            with span("handler"):
+                response = await callnext(request)
+        finally:
+            if db_connection is not None:
+                await constants.DB_POOL.release(db_connection)
+        request.state.db_conn = None
+        request.state.db_client = None
+
+    if response.status_code == 409:
+        hot_path_logger.info("Conflict on %s %s", request.method, request.url.path)
+
+    if trace.finish() > constants.trace_slow_request:
+        trace.export(request_id=request_id, user_id=user_id_var.get(), status_code=response.status_code)
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-Request-ID"] = request_id
     return response
 
 
@@ -113,30 +198,15 @@ async def auth_callback(request: fastapi.Request) -> fastapi.Response:
     code = request.query_params["code"]
     try:
         user, access_token = await get_oauth_user(httpx_client, code)
-        token = await add_user(user, request.state.db_conn)
+        async with constants.DB_POOL.acquire() as db_conn:
+            token = await add_user(user, db_conn)
+            if constants.enable_auto_join:
+                # Joining the guild is done in the background, so that logins don't wait on it
+                await auto_join_queue.enqueue(db_conn, int(user["id"]), access_token)
     except PermissionError:
         # `add_user` can return `PermissionError` if the user already has a token, which is banned.
         raise fastapi.HTTPException(401, "You are banned")
 
-    if constants.enable_auto_join:
-        # TODO: Make this a fastapi background task?
-        res = await httpx_client.put(
-            f"{constants.DISCORD_BASE_URL}/guilds/{constants.discord_guild_id}/members/{user['id']}",
-            json={"access_token": access_token},
-            headers={"Authorization": f"Bot {constants.discord_bot_token}"},
-        )
-        # 200: Success: Misc success
-        # 201: Created: user joined the server
-        # 204: No content: user already in the server
-        if res.status_code not in (200, 201, 204):
-            try:
-                # repr makes sure that no weird characters get printed and also allows
-                #  user to determine between response text of 'N/A' and real N/A
-                text = repr(res.text)
-            except Exception:
-                text = "N/A"
-            logger.error(f"Joining server for user failed: Code {res.status_code} text {text}")
-
     # Redirect so that a user doesn't refresh the page and spam discord
     redirect = RedirectResponse("/show_token", status_code=303)
     redirect.set_cookie(
@@ -187,25 +257,51 @@ async def roll(request: fastapi.Request) -> fastapi.Response:
 
 
 @app.get("/projects", tags=["Member endpoint"], response_model=List[ProjectDetails])
-async def get_projects(request: fastapi.Request) -> List[ProjectDetails]:
+async def get_projects(request: fastapi.Request) -> fastapi.Response:
     """Obtain all active project data."""
     request.state.auth.raise_if_failed()
-    return await fetch_projects(request.state.db_conn)
+    return responses.models_response(await database.fetch_projects(request.state.db_conn))
+
+
+@app.get("/projects/{name}/progress", tags=["Member endpoint"], response_model=ProjectProgress)
+async def get_project_progress(request: fastapi.Request, name: str) -> fastapi.Response:
+    """Obtain the completion state of a project, updated on every tasks refresh."""
+    request.state.auth.raise_if_failed()
+    return stats.project_progress(name)
+
+
+@app.get("/leaderboard", tags=["Member endpoint"], response_model=List[LeaderboardEntry])
+async def get_leaderboard(request: fastapi.Request) -> fastapi.Response:
+    """Obtain the top contributors by the amount of completed tasks, updated on every tasks refresh."""
+    request.state.auth.raise_if_failed()
+    return await stats.leaderboard(request.state.db_conn)
 
 
 @app.get("/task", tags=["Member endpoint"], response_model=Task)
-async def get_task(request: fastapi.Request) -> Task:
+async def get_task(request: fastapi.Request) -> fastapi.Response:
+    """Get a task assigned, the X-Lease-Expires-In header says how long do you have to submit it (seconds)."""
     request.state.auth.raise_if_failed()
     user_id = request.state.auth.user_id
-    return await tasks.assign_free_task(user_id)
+    task = await tasks.assign_free_task(user_id)
+    response = responses.task_response(task)
+    response.headers["X-Lease-Expires-In"] = f"{tasks.lease_time_left(user_id):.2f}"
+    return response
 
 
 @app.post("/task", tags=["Member endpoint"], response_model=Message)
-async def post_task(request: fastapi.Request, task: Task) -> Message:
+async def post_task(request: fastapi.Request, task: Task) -> fastapi.Response:
     request.state.auth.raise_if_failed()
     user_id = request.state.auth.user_id
     await tasks.submit_task(task, user_id)
-    return Message(message="Task submitted successfully.")
+    return responses.EncodedJSONResponse(responses.TASK_SUBMITTED)
+
+
+@app.post("/task/renew", tags=["Member endpoint"], response_model=TaskLease)
+async def renew_task(request: fastapi.Request) -> fastapi.Response:
+    """Extend the time you have to submit your assigned task, this can only be done a few times per task."""
+    request.state.auth.raise_if_failed()
+    user_id = request.state.auth.user_id
+    return responses.model_response(TaskLease(expires_in=tasks.renew_lease(user_id)))
 
 
 # endregion
@@ -213,118 +309,161 @@ async def post_task(request: fastapi.Request, task: Task) -> Message:
 
 
 @app.get("/mods/check", tags=["Moderation Endpoint"], response_model=Message)
-async def mod_check(request: fastapi.Request) -> Message:
+async def mod_check(request: fastapi.Request) -> fastapi.Response:
     """Check if the authenticated user is a mod."""
     request.state.auth.raise_unless_mod()
-    return Message(message="You are a moderator!")
+    return responses.EncodedJSONResponse(responses.MOD_CHECK)
 
 
-@app.post("/mods/promote", tags=["Moderation endpoint"], response_model=Message)
-async def promote_mod(request: fastapi.Request, user: User) -> Message:
-    """Make another user a moderator"""
+def _user_ids(users: Union[User, List[User]]) -> List[int]:
+    """Get the user ids from the body of a moderation endpoint, which can hold one or multiple users."""
+    if isinstance(users, list):
+        return [user.user_id for user in users]
+    return [users.user_id]
+
+
+@app.get("/mods/leases", tags=["Moderation endpoint"], response_model=LeaseStats)
+async def lease_stats(request: fastapi.Request) -> LeaseStats:
+    """Obtain task lease counters, to check how well are the lease durations tuned."""
     request.state.auth.raise_unless_mod()
 
-    db_conn = request.state.db_conn
-    async with db_conn.transaction():
-        user_state = await db_conn.fetchrow("SELECT is_mod FROM users WHERE user_id = $1;", user.user_id)
+    durations = [tasks.lease_duration(user_id) for user_id in tasks.user_latency]
+    return LeaseStats(
+        assigned=tasks.lease_stats["assigned"],
+        renewed=tasks.lease_stats["renewed"],
+        expired=tasks.lease_stats["expired"],
+        submitted=tasks.lease_stats["submitted"],
+        late_submits=tasks.lease_stats["late_submits"],
+        active=len(tasks.leases),
+        tracked_users=len(durations),
+        mean_lease=sum(durations) / len(durations) if durations else constants.task_pending_delay,
+    )
+
 
-        if user_state is None:
-            raise fastapi.HTTPException(status_code=404, detail=f"User with user_id {user.user_id} does not exist.")
-        elif user_state["is_mod"]:
-            raise fastapi.HTTPException(status_code=409, detail=f"User with user_id {user.user_id} is already a mod")
+@app.get("/mods/admission", tags=["Moderation endpoint"], response_model=AdmissionStats)
+async def admission_stats(request: fastapi.Request) -> AdmissionStats:
+    """Obtain the amount of rejected requests per route, to check how well are the rate limits tuned."""
+    request.state.auth.raise_unless_mod()
 
-        await db_conn.execute("UPDATE users SET is_mod = true WHERE user_id = $1;", user.user_id)
-    return Message(message=f"Successfully promoted user with user_id {user.user_id} to mod")
+    tracked_users = {f"{method} {path}": len(limiter) for (method, path), limiter in ratelimit.route_limiters.items()}
+    return AdmissionStats(
+        rejected=ratelimit.rejected,
+        verifications_running=ratelimit.verifications_running,
+        tracked_users=tracked_users,
+    )
 
 
-@app.post("/mods/demote", tags=["Moderation endpoint"], response_model=Message)
-async def demote_mod(request: fastapi.Request, user: User) -> Message:
-    """Make another user a moderator"""
+@app.get("/mods/history", tags=["Moderation endpoint"], response_model=CanvasHistoryStats)
+async def history_stats(request: fastapi.Request) -> CanvasHistoryStats:
+    """Obtain the canvas history usage and the amount of completed pixels which got griefed."""
     request.state.auth.raise_unless_mod()
 
-    db_conn = request.state.db_conn
-    async with db_conn.transaction():
-        user_state = await db_conn.fetchrow("SELECT is_mod FROM users WHERE user_id = $1;", user.user_id)
+    return CanvasHistoryStats(
+        frames=len(canvas_history),
+        size_bytes=canvas_history.nbytes,
+        covered_seconds=canvas_history.latest_time - canvas_history.oldest_time if len(canvas_history) else 0,
+        instant_verifications=tasks.history_stats["instant_verifications"],
+        reverts=tasks.history_stats["reverts"],
+        watched_pixels=len(tasks.completed_pixels),
+        griefed_pixels=len(tasks.griefed_pixels),
+    )
+
 
-        if user_state is None:
-            raise fastapi.HTTPException(status_code=404, detail=f"User with user_id {user.user_id} does not exist.")
-        elif user_state["is_mod"] is False:
-            raise fastapi.HTTPException(status_code=409, detail=f"User with user_id {user.user_id} isn't a mod.")
+@app.get("/mods/profile", tags=["Moderation endpoint"], response_class=PlainTextResponse)
+async def profile(
+    request: fastapi.Request,
+    seconds: float = fastapi.Query(5.0, gt=0, le=constants.profile_max_seconds)  # noqa: B008
+) -> PlainTextResponse:
+    """Sample the event loop for given amount of seconds, return the stacks in the collapsed (flamegraph) format."""
+    request.state.auth.raise_unless_mod()
 
-        await db_conn.execute("UPDATE users SET is_mod = false WHERE user_id = $1;", user.user_id)
-    return Message(message=f"Successfully demoted user with user_id {user.user_id} to regular user")
+    try:
+        stacks = await profile_event_loop(seconds)
+    except RuntimeError as exc:
+        raise fastapi.HTTPException(status_code=409, detail=str(exc))
+    return PlainTextResponse(stacks)
 
 
-@app.post("/mods/ban", tags=["Moderation endpoint"], response_model=Message)
-async def ban_user(request: fastapi.Request, user: User) -> Message:
-    """Ban users from using the API."""
+@app.post("/mods/promote", tags=["Moderation endpoint"], response_model=Union[Message, BulkModerationResult])
+async def promote_mod(
+    request: fastapi.Request, users: Union[User, List[User]]
+) -> fastapi.Response:
+    """Make other users moderators, accepts a single user or a list of users."""
     request.state.auth.raise_unless_mod()
 
-    db_conn = request.state.db_conn
-    db_user = await db_conn.fetch("SELECT * FROM users WHERE user_id=$1", user.user_id)
+    result = await database.set_mod_status(request.state.db_conn, _user_ids(users), True)
+    if isinstance(users, list):
+        return responses.model_response(result)
+
+    if result.not_found:
+        raise fastapi.HTTPException(status_code=404, detail=f"User with user_id {users.user_id} does not exist.")
+    elif result.unchanged:
+        raise fastapi.HTTPException(status_code=409, detail=f"User with user_id {users.user_id} is already a mod")
+    return responses.message_response(f"Successfully promoted user with user_id {users.user_id} to mod")
+
+
+@app.post("/mods/demote", tags=["Moderation endpoint"], response_model=Union[Message, BulkModerationResult])
+async def demote_mod(
+    request: fastapi.Request, users: Union[User, List[User]]
+) -> fastapi.Response:
+    """Make moderators regular users, accepts a single user or a list of users."""
+    request.state.auth.raise_unless_mod()
+
+    result = await database.set_mod_status(request.state.db_conn, _user_ids(users), False)
+    if isinstance(users, list):
+        return responses.model_response(result)
+
+    if result.not_found:
+        raise fastapi.HTTPException(status_code=404, detail=f"User with user_id {users.user_id} does not exist.")
+    elif result.unchanged:
+        raise fastapi.HTTPException(status_code=409, detail=f"User with user_id {users.user_id} isn't a mod.")
+    return responses.message_response(f"Successfully demoted user with user_id {users.user_id} to regular user")
+
+
+@app.post("/mods/ban", tags=["Moderation endpoint"], response_model=Union[Message, BulkModerationResult])
+async def ban_user(
+    request: fastapi.Request, users: Union[User, List[User]]
+) -> fastapi.Response:
+    """Ban users from using the API, accepts a single user or a list of users."""
+    request.state.auth.raise_unless_mod()
 
-    if not db_user:
-        raise fastapi.HTTPException(status_code=404, detail=f"User with user_id {user.user_id} does not exist.")
+    result = await database.ban_users(request.state.db_conn, _user_ids(users))
+    if isinstance(users, list):
+        return responses.model_response(result)
 
-    await db_conn.execute("UPDATE users SET is_banned=TRUE WHERE user_id=$1", user.user_id)
-    return Message(message=f"Successfully banned user_id {user.user_id}")
+    if result.not_found:
+        raise fastapi.HTTPException(status_code=404, detail=f"User with user_id {users.user_id} does not exist.")
+    return responses.message_response(f"Successfully banned user_id {users.user_id}")
 
 
 @app.post("/mods/project", tags=["Moderation endpoint"], response_model=Message)
-async def add_project(request: fastapi.Request, project: ProjectDetails) -> Message:
+async def add_project(request: fastapi.Request, project: ProjectDetails) -> fastapi.Response:
     """Add a new project"""
     request.state.auth.raise_unless_mod()
 
-    db_conn = request.state.db_conn
-    db_project = await db_conn.fetchrow("SELECT * FROM projects WHERE project_name=$1", project.name)
-
-    if db_project is not None:
+    if not await database.insert_project(request.state.db_conn, project):
         raise fastapi.HTTPException(status_code=409, detail=f"Database project {project.name} already exists.")
-
-    # fmt: off
-    await db_conn.execute(
-        """INSERT INTO projects (project_name, position_x, position_y, project_priority, base64_image)
-        VALUES ($1, $2, $3, $4, $5)""",
-        project.name, project.x, project.y, project.priority, project.image
-    )
-    # fmt: on
-    return Message(message=f"Project {project.name} was added successfully.")
+    return responses.message_response(f"Project {project.name} was added successfully.")
 
 
 @app.delete("/mods/project", tags=["Moderation endpoint"], response_model=Message)
-async def remove_project(request: fastapi.Request, project: Project) -> Message:
-    """Add a new project"""
+async def remove_project(request: fastapi.Request, project: Project) -> fastapi.Response:
+    """Remove a project"""
     request.state.auth.raise_unless_mod()
 
-    db_conn = request.state.db_conn
-    db_project = await db_conn.fetchrow("SELECT * FROM projects WHERE project_name=$1", project.name)
-
-    if db_project is None:
+    if not await database.delete_project(request.state.db_conn, project.name):
         raise fastapi.HTTPException(status_code=404, detail=f"Database project {project.name} doesn't exist.")
-
-    await db_conn.execute("DELETE FROM projects WHERE project_name=$1", project.name)
-    return Message(message=f"Project {project.name} was removed successfully.")
+    return responses.message_response(f"Project {project.name} was removed successfully.")
 
 
 @app.put("/mods/project", tags=["Moderation endpoint"], response_model=Message)
-async def put_project(request: fastapi.Request, project: ProjectDetails) -> Message:
+async def put_project(request: fastapi.Request, project: ProjectDetails) -> fastapi.Response:
     """Update an existing project"""
     request.state.auth.raise_unless_mod()
 
-    db_conn = request.state.db_conn
-    db_project = await db_conn.fetchrow("SELECT * FROM projects WHERE project_name=$1", project.name)
-
-    if db_project is None:
+    if not await database.update_project(request.state.db_conn, project):
         raise fastapi.HTTPException(status_code=404, detail=f"Database project {project.name} doesn't exist.")
-
-    # fmt: off
-    await db_conn.execute(
-        """UPDATE projects SET project_name=$1, position_x=$2, position_y=$3, project_priority=$4, base64_image=$5
-        WHERE project_name=$1""",
-        project.name, project.x, project.y, project.priority, project.image
-    )
-    # fmt: on
-    return Message(message=f"Project {project.name} was updated successfully.")
+    return responses.message_response(f"Project {project.name} was updated successfully.")
 
 
 # endregion
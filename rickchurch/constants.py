@@ -7,6 +7,22 @@ from decouple import config
 DISCORD_BASE_URL = "https://discord.com/api"
 
 log_level: str = config("LOG_LEVEL", default="INFO")
+# Either "color" for human readable output, or "json" for one JSON object per line (with request and user ids)
+log_format: str = config("LOG_FORMAT", default="color")
+# How many of the same messages logged on every request (failed auths, 409s, ...) can go through per second
+log_hot_path_rate: int = config("LOG_HOT_PATH_RATE", cast=int, default=10)
+
+# Requests and tasks refreshes slower than these (seconds) get their per-phase timings
+# written into `trace_export_path` as JSON lines, leave the path empty to disable this.
+# Task submissions can wait for the next canvas (up to `task_refresh_time`), keep the request threshold above it.
+trace_slow_request: float = config("TRACE_SLOW_REQUEST", cast=float, default=3.0)
+trace_slow_refresh: float = config("TRACE_SLOW_REFRESH", cast=float, default=5.0)
+trace_export_path: str = config("TRACE_EXPORT_PATH", default="logs/slow_traces.jsonl")
+# The traces file is rotated once it's this big (bytes), keeping `trace_export_backups` old files
+trace_export_max_bytes: int = config("TRACE_EXPORT_MAX_BYTES", cast=int, default=10 * 1024 * 1024)
+trace_export_backups: int = config("TRACE_EXPORT_BACKUPS", cast=int, default=3)
+# Longest event loop profile mods can request (seconds)
+profile_max_seconds: float = config("PROFILE_MAX_SECONDS", cast=float, default=60.0)
 
 base_url: str = config("BASE_URL")  # URL to host church of rick
 
@@ -19,14 +35,71 @@ oauth_redirect_url: str = config("OAUTH_REDIRECT_URL")
 enable_auto_join: bool = config("ENABLE_DISCORD_AUTOJOIN", default=False, cast=bool)
 discord_guild_id: str = config("DISCORD_GUILD_ID") if enable_auto_join else ""
 discord_bot_token: str = config("DISCORD_BOT_TOKEN") if enable_auto_join else ""
+# Guild joins are processed in the background by this many workers, each join is tried up to max attempts times
+auto_join_workers: int = config("AUTO_JOIN_WORKERS", cast=int, default=2)
+auto_join_max_attempts: int = config("AUTO_JOIN_MAX_ATTEMPTS", cast=int, default=5)
+
+# Connection pool of the HTTP client used for discord's API
+discord_max_connections: int = config("DISCORD_MAX_CONNECTIONS", cast=int, default=20)
+discord_max_keepalive: int = config("DISCORD_MAX_KEEPALIVE", cast=int, default=10)
+discord_timeout: float = config("DISCORD_TIMEOUT", cast=float, default=10.0)
 
 jwt_secret: str = config("JWT_SECRET")
 
-# How long should a task stay assigned to the user who requested it (seconds)
+# How long should a task stay assigned to the user who requested it (seconds),
+# this is only used for users who didn't submit any tasks yet, see below
 task_pending_delay: float = config("TASK_PENDING_DELAY", default=5.0, cast=float)
+# Once a user submits a task, their lease is their smoothed claim-to-submit latency
+# multiplied by `task_lease_factor`, kept within `task_lease_min` and `task_lease_max` (seconds).
+# `task_lease_smoothing` is the weight of the newest latency sample (0-1).
+task_lease_min: float = config("TASK_LEASE_MIN", default=2.0, cast=float)
+task_lease_max: float = config("TASK_LEASE_MAX", default=20.0, cast=float)
+task_lease_factor: float = config("TASK_LEASE_FACTOR", default=2.0, cast=float)
+task_lease_smoothing: float = config("TASK_LEASE_SMOOTHING", default=0.3, cast=float)
+# How many times can a single task lease be renewed
+task_max_renewals: int = config("TASK_MAX_RENEWALS", default=3, cast=int)
+
+# Every user can make up to `burst` requests to the task endpoints right away, refilled at `rate`
+# requests per second, requests over the limit get a 429 with a Retry-After header
+task_get_rate: float = config("TASK_GET_RATE", default=2.0, cast=float)
+task_get_burst: int = config("TASK_GET_BURST", default=5, cast=int)
+task_post_rate: float = config("TASK_POST_RATE", default=2.0, cast=float)
+task_post_burst: int = config("TASK_POST_BURST", default=5, cast=int)
+# How many task submissions can be verified at once, verifying can make requests to the pixels API
+max_concurrent_verifications: int = config("MAX_CONCURRENT_VERIFICATIONS", default=20, cast=int)
 # How often should we refresh all tasks from database and refetch the canvas (seconds)
 task_refresh_time: float = config("TASK_REFRESH_TIME", default=2.0, cast=float)
 
+# Completed tasks are written to the database in batches, once this many are pending,
+# or every `contribution_flush_interval` seconds, whichever comes first
+contribution_flush_size: int = config("CONTRIBUTION_FLUSH_SIZE", cast=int, default=500)
+contribution_flush_interval: float = config("CONTRIBUTION_FLUSH_INTERVAL", cast=float, default=5.0)
+# How many completion events can be buffered (e.g. while the database is unreachable)
+# before the oldest ones start being dropped, per-user counters are never dropped
+contribution_max_pending: int = config("CONTRIBUTION_MAX_PENDING", cast=int, default=50_000)
+# How many top contributors should be shown in the leaderboard
+leaderboard_size: int = config("LEADERBOARD_SIZE", cast=int, default=10)
+
+# Recently fetched canvases are kept to verify submissions against every canvas fetched since the task was
+# claimed, instead of waiting for a newer one. The oldest ones are dropped once there are more than
+# `canvas_history_frames` of them, or once they take up more than `canvas_history_bytes` (only the oldest
+# canvas is kept whole, the others are kept as their changed pixels), set the frames to 0 to disable this
+canvas_history_frames: int = config("CANVAS_HISTORY_FRAMES", cast=int, default=30)
+canvas_history_bytes: int = config("CANVAS_HISTORY_BYTES", cast=int, default=32 * 1024 * 1024)
+# Pixels which got reverted after their task was completed are handed out before the others for this long (seconds)
+griefed_pixel_time: float = config("GRIEFED_PIXEL_TIME", cast=float, default=600.0)
+
+# When running multiple worker processes, enable this to only fetch the canvas from one of them (the leader)
+# and share it with the others through shared memory. The leader is whoever holds a lock on `shared_canvas_lock`.
+shared_canvas: bool = config("SHARED_CANVAS", cast=bool, default=False)
+shared_canvas_name: str = config("SHARED_CANVAS_NAME", default="rickchurch_canvas")
+shared_canvas_lock: str = config("SHARED_CANVAS_LOCK", default="/tmp/rickchurch_canvas.lock")
+# Maximum size of the shared canvas (bytes), 3 bytes per pixel
+shared_canvas_size: int = config("SHARED_CANVAS_SIZE", cast=int, default=8 * 1024 * 1024)
+# Once the shared canvas is older than this (seconds), the leader is considered stuck,
+# and the other processes fetch the canvas themselves
+shared_canvas_max_age: float = config("SHARED_CANVAS_MAX_AGE", cast=float, default=5 * task_refresh_time)
+
 # PostgreSQL Database
 database_url: str = config("DATABASE_URL")
 min_pool_size: int = config("MIN_POOL_SIZE", cast=int, default=2)
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import DefaultDict, Dict, List, NamedTuple, Optional
+
+from rickchurch import constants, database
+from rickchurch.models import Task
+
+logger = logging.getLogger("rickchurch")
+
+
+class CompletionEvent(NamedTuple):
+    """A single completed task, in the column order of the `task_completions` table."""
+
+    user_id: int
+    position_x: int
+    position_y: int
+    rgb: str
+    project_name: str
+    completed_at: datetime
+
+
+class ContributionRecorder:
+    """
+    Write-behind buffer for completed tasks.
+
+    Submitting a task only appends to the in-memory buffers, the database is written
+    to from a background task in batches, once `flush_size` events are pending or
+    every `flush_interval` seconds, whichever comes first.
+    """
+
+    def __init__(self, flush_size: int, flush_interval: float, max_pending: int) -> None:
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._events: List[CompletionEvent] = []
+        self._counters: DefaultDict[int, int] = defaultdict(int)
+        self._dropped = 0
+        # Total completed tasks of every contributing user, including the ones that weren't flushed yet.
+        # Reloaded after the flushes, so that it includes the tasks completed through the other processes too.
+        self.totals: Dict[int, int] = {}
+        self._reloaded_at = float("-inf")  # From `time.monotonic`
+
+        # These are bound to the running event loop, so they're only made in `start`
+        self._flush_needed: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(self, task: Task, user_id: int) -> None:
+        """Buffer a `task` completed by `user_id`, this never waits on the database."""
+        self._counters[user_id] += 1
+        self.totals[user_id] = self.totals.get(user_id, 0) + 1
+        self._events.append(CompletionEvent(
+            user_id, task.x, task.y, task.rgb, task.project_name, datetime.now(timezone.utc)
+        ))
+        self._trim()
+
+        if len(self._events) >= self.flush_size and self._flush_needed is not None:
+            self._flush_needed.set()
+
+    async def start(self) -> None:
+        """Load the stored contribution totals and start flushing the buffered data in the background."""
+        async with constants.DB_POOL.acquire() as db_conn:
+            self.totals = await database.fetch_contribution_totals(db_conn)
+        self._reloaded_at = time.monotonic()
+
+        self._flush_needed = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """Stop the background flushing and write out everything that's still buffered."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception(f"Final contribution flush failed, {len(self._events)} completion events were lost")
+
+    async def flush(self) -> None:
+        """Write all buffered completion events and counters to the database in a single transaction."""
+        if self._flush_lock is None:
+            raise RuntimeError("ContributionRecorder wasn't started.")
+
+        async with self._flush_lock:
+            if self._dropped:
+                logger.warning(f"Contribution buffer overflowed, dropped {self._dropped} oldest completion events")
+                self._dropped = 0
+
+            if not self._events and not self._counters:
+                return
+
+            events, self._events = self._events, []
+            counters, self._counters = self._counters, defaultdict(int)
+            try:
+                async with constants.DB_POOL.acquire() as db_conn:
+                    await database.write_contributions(db_conn, events, counters.items())
+            except BaseException:
+                # Put the batch back in front of whatever got buffered meanwhile, it will be retried on next flush
+                self._events[:0] = events
+                for user_id, count in counters.items():
+                    self._counters[user_id] += count
+                self._trim()
+                raise
+
+        logger.debug(f"Flushed {len(events)} completion events from {len(counters)} users")
+
+    async def reload_totals(self) -> None:
+        """Reload the contribution totals from the database and add in the tasks which weren't flushed yet."""
+        if self._flush_lock is None:
+            raise RuntimeError("ContributionRecorder wasn't started.")
+
+        # A batch which is being flushed is neither in the buffers, nor in the database yet
+        async with self._flush_lock:
+            async with constants.DB_POOL.acquire() as db_conn:
+                totals = await database.fetch_contribution_totals(db_conn)
+
+            for user_id, count in self._counters.items():
+                totals[user_id] = totals.get(user_id, 0) + count
+            self.totals = totals
+            self._reloaded_at = time.monotonic()
+
+    def _trim(self) -> None:
+        """Drop the oldest events if there's more than `max_pending` of them, the counters are always kept."""
+        overflow = len(self._events) - self.max_pending
+        if overflow > 0:
+            del self._events[:overflow]
+            self._dropped += overflow
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()  # type: ignore - this is set in `start`
+
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Unable to flush contributions, retrying on next flush")
+                # The batch was put back, so every submit would trigger a retry, wait out the interval first
+                await asyncio.sleep(self.flush_interval)
+                continue
+
+            # Flushes can be triggered by every `flush_size` submits, reload the totals at most once an interval
+            if time.monotonic() - self._reloaded_at < self.flush_interval:
+                continue
+            try:
+                await self.reload_totals()
+            except Exception:
+                logger.exception("Unable to reload contribution totals, retrying after next flush")
+
+
+recorder = ContributionRecorder(
+    constants.contribution_flush_size,
+    constants.contribution_flush_interval,
+    constants.contribution_max_pending,
+)
@@ -0,0 +1,213 @@
+# All of the SQL used by the API. Every operation is a single statement, so it only takes a single
+# round trip. asyncpg prepares each of these queries once per connection and then reuses the prepared
+# statement from its statement cache, so we don't need to call `Connection.prepare` ourselves.
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+from rickchurch.models import BulkModerationResult, ProjectDetails
+
+# region: Users
+
+_FETCH_USER_STATE = "SELECT is_banned, is_mod, key_salt FROM users WHERE user_id = $1"
+
+# Only resets the salt of users who aren't banned, returns `NULL` for banned users
+_UPSERT_USER = """
+INSERT INTO users (user_id, user_name, key_salt) VALUES ($1, $2, $3)
+ON CONFLICT (user_id) DO UPDATE SET key_salt = EXCLUDED.key_salt WHERE NOT users.is_banned
+RETURNING true
+"""
+
+_FETCH_USER_NAMES = "SELECT user_id, user_name FROM users WHERE user_id = ANY($1::int8[])"
+
+# Sets a boolean `column` for all given user ids, reporting which of them were
+# changed and which of them exist, all in one statement. The final SELECT sees
+# the table as it was before the UPDATE, which is enough to check existence.
+_SET_USER_FLAG_TEMPLATE = """
+WITH targets AS (
+    SELECT DISTINCT unnest($1::int8[]) AS user_id
+), updated AS (
+    UPDATE users SET {column} = $2 FROM targets
+    WHERE users.user_id = targets.user_id AND users.{column} <> $2
+    RETURNING users.user_id
+)
+SELECT targets.user_id, updated.user_id IS NOT NULL AS updated, users.user_id IS NOT NULL AS found
+FROM targets
+LEFT JOIN updated ON updated.user_id = targets.user_id
+LEFT JOIN users ON users.user_id = targets.user_id
+"""
+_SET_USER_FLAG = {column: _SET_USER_FLAG_TEMPLATE.format(column=column) for column in ("is_mod", "is_banned")}
+
+
+async def fetch_user_state(db_conn: asyncpg.Connection, user_id: int) -> Optional[asyncpg.Record]:
+    """Get the `is_banned`, `is_mod` and `key_salt` of given user, or `None` if they don't exist."""
+    return await db_conn.fetchrow(_FETCH_USER_STATE, user_id)
+
+
+async def upsert_user(db_conn: asyncpg.Connection, user_id: int, user_name: str, key_salt: str) -> bool:
+    """
+    Add a new user with given `key_salt`, or set the `key_salt` of an existing user.
+
+    Return `False` if the user already exists and is banned, their salt is left unchanged then.
+    """
+    return await db_conn.fetchval(_UPSERT_USER, user_id, user_name, key_salt) is not None
+
+
+async def fetch_user_names(db_conn: asyncpg.Connection, user_ids: List[int]) -> Dict[int, str]:
+    """Get the user names of all existing users from `user_ids`."""
+    db_users = await db_conn.fetch(_FETCH_USER_NAMES, user_ids)
+    return {db_user["user_id"]: db_user["user_name"] for db_user in db_users}
+
+
+async def _set_user_flag(
+    db_conn: asyncpg.Connection, column: str, user_ids: List[int], value: bool
+) -> BulkModerationResult:
+    db_results = await db_conn.fetch(_SET_USER_FLAG[column], user_ids, value)
+
+    result = BulkModerationResult(updated=[], unchanged=[], not_found=[])
+    for db_result in db_results:
+        if db_result["updated"]:
+            result.updated.append(db_result["user_id"])
+        elif db_result["found"]:
+            result.unchanged.append(db_result["user_id"])
+        else:
+            result.not_found.append(db_result["user_id"])
+    return result
+
+
+async def set_mod_status(db_conn: asyncpg.Connection, user_ids: List[int], is_mod: bool) -> BulkModerationResult:
+    """Promote or demote all users from `user_ids`."""
+    return await _set_user_flag(db_conn, "is_mod", user_ids, is_mod)
+
+
+async def ban_users(db_conn: asyncpg.Connection, user_ids: List[int]) -> BulkModerationResult:
+    """Ban all users from `user_ids`."""
+    return await _set_user_flag(db_conn, "is_banned", user_ids, True)
+
+
+# endregion
+# region: Projects
+
+_FETCH_PROJECTS = "SELECT * FROM projects"
+
+_INSERT_PROJECT = """
+INSERT INTO projects (project_name, position_x, position_y, project_priority, base64_image)
+VALUES ($1, $2, $3, $4, $5)
+ON CONFLICT (project_name) DO NOTHING
+RETURNING true
+"""
+
+_UPDATE_PROJECT = """
+UPDATE projects SET position_x = $2, position_y = $3, project_priority = $4, base64_image = $5
+WHERE project_name = $1
+RETURNING true
+"""
+
+_DELETE_PROJECT = "DELETE FROM projects WHERE project_name = $1 RETURNING true"
+
+
+async def fetch_projects(db_conn: asyncpg.Connection) -> List[ProjectDetails]:
+    """Obtain list of active projects in the database"""
+    db_projects = await db_conn.fetch(_FETCH_PROJECTS)
+
+    projects = []
+    for db_project in db_projects:
+        project = ProjectDetails(
+            name=db_project["project_name"],
+            x=db_project["position_x"],
+            y=db_project["position_y"],
+            priority=db_project["project_priority"],
+            image=db_project["base64_image"],
+        )
+        projects.append(project)
+    return projects
+
+
+async def insert_project(db_conn: asyncpg.Connection, project: ProjectDetails) -> bool:
+    """Add a new project, return `False` if a project with the same name already exists."""
+    # fmt: off
+    result = await db_conn.fetchval(
+        _INSERT_PROJECT,
+        project.name, project.x, project.y, project.priority, project.image
+    )
+    # fmt: on
+    return result is not None
+
+
+async def update_project(db_conn: asyncpg.Connection, project: ProjectDetails) -> bool:
+    """Update an existing project, return `False` if there is no project with this name."""
+    # fmt: off
+    result = await db_conn.fetchval(
+        _UPDATE_PROJECT,
+        project.name, project.x, project.y, project.priority, project.image
+    )
+    # fmt: on
+    return result is not None
+
+
+async def delete_project(db_conn: asyncpg.Connection, project_name: str) -> bool:
+    """Remove a project, return `False` if there is no project with this name."""
+    return await db_conn.fetchval(_DELETE_PROJECT, project_name) is not None
+
+
+# endregion
+# region: Contributions
+
+_COMPLETION_COLUMNS = ("user_id", "position_x", "position_y", "rgb", "project_name", "completed_at")
+
+_FETCH_CONTRIBUTION_TOTALS = "SELECT user_id, projects_complete FROM users WHERE projects_complete > 0"
+
+_ADD_CONTRIBUTIONS = "UPDATE users SET projects_complete = projects_complete + $2 WHERE user_id = $1"
+
+
+async def fetch_contribution_totals(db_conn: asyncpg.Connection) -> Dict[int, int]:
+    """Get the amount of completed tasks of every user who completed any."""
+    db_totals = await db_conn.fetch(_FETCH_CONTRIBUTION_TOTALS)
+    return {db_total["user_id"]: db_total["projects_complete"] for db_total in db_totals}
+
+
+async def write_contributions(
+    db_conn: asyncpg.Connection, events: Sequence[tuple], counters: Iterable[Tuple[int, int]]
+) -> None:
+    """
+    Store a batch of completion `events` (in the column order of `task_completions`)
+    and add the `(user_id, count)` pairs from `counters` to the users' totals.
+    """
+    async with db_conn.transaction():
+        if events:
+            await db_conn.copy_records_to_table("task_completions", records=events, columns=_COMPLETION_COLUMNS)
+        await db_conn.executemany(_ADD_CONTRIBUTIONS, counters)
+
+
+# endregion
+# region: Auto-join jobs
+
+# There's only ever one pending job per user, newer logins just replace the access token
+_STORE_AUTO_JOIN_JOB = """
+INSERT INTO auto_join_jobs (user_id, access_token) VALUES ($1, $2)
+ON CONFLICT (user_id) DO UPDATE SET access_token = EXCLUDED.access_token
+"""
+
+_FETCH_AUTO_JOIN_JOBS = "SELECT user_id, access_token FROM auto_join_jobs ORDER BY created_at"
+
+# Only delete the job if it wasn't replaced by a newer login meanwhile
+_DELETE_AUTO_JOIN_JOB = "DELETE FROM auto_join_jobs WHERE user_id = $1 AND access_token = $2"
+
+
+async def store_auto_join_job(db_conn: asyncpg.Connection, user_id: int, access_token: str) -> None:
+    """Persist a pending guild join of `user_id`."""
+    await db_conn.execute(_STORE_AUTO_JOIN_JOB, user_id, access_token)
+
+
+async def fetch_auto_join_jobs(db_conn: asyncpg.Connection) -> List[Tuple[int, str]]:
+    """Get the `(user_id, access_token)` pairs of all pending guild joins, oldest first."""
+    db_jobs = await db_conn.fetch(_FETCH_AUTO_JOIN_JOBS)
+    return [(db_job["user_id"], db_job["access_token"]) for db_job in db_jobs]
+
+
+async def delete_auto_join_job(db_conn: asyncpg.Connection, user_id: int, access_token: str) -> None:
+    """Remove a finished guild join job."""
+    await db_conn.execute(_DELETE_AUTO_JOIN_JOB, user_id, access_token)
+
+
+# endregion
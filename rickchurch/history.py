@@ -0,0 +1,155 @@
+import bisect
+import re
+from array import array
+from collections import deque
+from typing import Deque, Iterator, NamedTuple, Optional, Tuple
+
+import PIL.Image
+import PIL.ImageChops
+
+from rickchurch import constants
+
+
+class Delta(NamedTuple):
+    """Pixels of a canvas which changed since the previous one, XOR-ed with their previous colors."""
+
+    fetch_time: float
+    # Sorted y * width + x of every changed pixel, or `None` if most of them changed and `xor` covers the whole canvas
+    indices: Optional[array]
+    xor: bytes  # 3 bytes for every changed pixel, or for every pixel if there are no `indices`
+
+    @property
+    def nbytes(self) -> int:
+        if self.indices is None:
+            return len(self.xor)
+        return len(self.indices) * self.indices.itemsize + len(self.xor)
+
+    def lookup(self, pixel_no: int) -> Optional[bytes]:
+        """Get the XOR of the pixel `pixel_no`, or `None` if it didn't change."""
+        if self.indices is None:
+            xor = self.xor[pixel_no * 3:pixel_no * 3 + 3]
+            return xor if any(xor) else None
+
+        i = bisect.bisect_left(self.indices, pixel_no)
+        if i == len(self.indices) or self.indices[i] != pixel_no:
+            return None
+        return self.xor[i * 3:i * 3 + 3]
+
+    def expand(self) -> bytes:
+        """Get the XOR of every pixel of the canvas, with zeros for the ones that didn't change."""
+        if self.indices is None:
+            return self.xor
+
+        dense = bytearray(self.indices[-1] * 3 + 3 if self.indices else 0)
+        for n, pixel_no in enumerate(self.indices):
+            dense[pixel_no * 3:pixel_no * 3 + 3] = self.xor[n * 3:n * 3 + 3]
+        return dense
+
+
+_NON_ZERO = re.compile(rb"[^\x00]")
+
+
+def _diff(old: bytes, new: bytes, size: Tuple[int, int], fetch_time: float) -> Delta:
+    xor = (int.from_bytes(old, "little") ^ int.from_bytes(new, "little")).to_bytes(len(new), "little")
+    # A pixel changed if any of its channels did
+    red, green, blue = PIL.Image.frombytes("RGB", size, xor).split()
+    changed = PIL.ImageChops.lighter(PIL.ImageChops.lighter(red, green), blue).tobytes()
+    if changed.count(0) <= len(changed) * 7 // 8:
+        # Too many changed pixels to list them, that would take longer and more memory than keeping all of them
+        return Delta(fetch_time, None, xor)
+
+    indices = array("I", [match.start() for match in _NON_ZERO.finditer(changed)])
+    return Delta(fetch_time, indices, b"".join([xor[i * 3:i * 3 + 3] for i in indices]))
+
+
+class CanvasHistory:
+    """
+    Ring buffer of the recently fetched canvases.
+
+    The oldest canvas (the base frame) is kept whole, every newer one is only kept as a delta
+    against the one before it. Once there are more than `max_frames` frames, or they take up
+    more than `max_bytes`, the oldest delta gets folded into the base frame.
+    """
+
+    def __init__(self, max_frames: int, max_bytes: int) -> None:
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.size = (0, 0)
+
+        self._base = bytearray()
+        self._base_time = float("-inf")
+        self._deltas: Deque[Delta] = deque()
+        self._deltas_nbytes = 0
+        # Whole newest canvas, the next delta is made against it
+        self._latest = b""
+
+    def __len__(self) -> int:
+        return len(self._deltas) + 1 if self._base else 0
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._base) + len(self._latest) + self._deltas_nbytes
+
+    @property
+    def oldest_time(self) -> float:
+        return self._base_time
+
+    @property
+    def latest_time(self) -> float:
+        return self._deltas[-1].fetch_time if self._deltas else self._base_time
+
+    def append(self, raw: bytes, size: Tuple[int, int], fetch_time: float) -> None:
+        """Add a canvas fetched at `fetch_time`, the canvases have to be added in the order they were fetched in."""
+        if self.max_frames <= 0 or fetch_time <= self.latest_time:
+            return
+
+        if size != self.size or not self._base:
+            # Nothing to diff against, or the canvas got resized, start over
+            self.size = size
+            self._base = bytearray(raw)
+            self._base_time = fetch_time
+            self._deltas.clear()
+            self._deltas_nbytes = 0
+            self._latest = raw
+            return
+
+        delta = _diff(self._latest, raw, size, fetch_time)
+        self._deltas.append(delta)
+        self._deltas_nbytes += delta.nbytes
+        self._latest = raw
+
+        while self._deltas and (len(self) > self.max_frames or self.nbytes > self.max_bytes):
+            self._fold_oldest()
+
+    def _fold_oldest(self) -> None:
+        delta = self._deltas.popleft()
+        self._deltas_nbytes -= delta.nbytes
+        # The expanded XOR can be shorter than the canvas, the bytes past its end didn't change
+        xor = int.from_bytes(self._base, "little") ^ int.from_bytes(delta.expand(), "little")
+        self._base = bytearray(xor.to_bytes(len(self._base), "little"))
+        self._base_time = delta.fetch_time
+
+    def pixel_history(self, x: int, y: int) -> Iterator[Tuple[float, Tuple[int, int, int]]]:
+        """Yield the fetch time and the color of the pixel at `x, y` in every kept canvas, oldest first."""
+        width, height = self.size
+        if not self._base or not (0 <= x < width and 0 <= y < height):
+            return
+
+        pixel_no = y * width + x
+        red, green, blue = self._base[pixel_no * 3:pixel_no * 3 + 3]
+        yield self._base_time, (red, green, blue)
+        for delta in self._deltas:
+            xor = delta.lookup(pixel_no)
+            if xor is not None:
+                red, green, blue = red ^ xor[0], green ^ xor[1], blue ^ xor[2]
+            yield delta.fetch_time, (red, green, blue)
+
+    def matched_since(self, x: int, y: int, color: Tuple[int, int, int], since: float) -> Optional[float]:
+        """Get the fetch time of the first canvas fetched after `since` with the pixel at `x, y` in `color`."""
+        for fetch_time, pixel_color in self.pixel_history(x, y):
+            if fetch_time >= since and pixel_color == color:
+                return fetch_time
+        return None
+
+
+canvas_history = CanvasHistory(constants.canvas_history_frames, constants.canvas_history_bytes)
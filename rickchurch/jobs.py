@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from typing import List, NamedTuple, Optional
+
+import asyncpg
+import httpx
+
+from rickchurch import constants, database
+
+logger = logging.getLogger("rickchurch")
+
+
+class AutoJoinJob(NamedTuple):
+    """Add the user to our discord guild, on their behalf (using their OAuth access token)."""
+
+    user_id: int
+    access_token: str
+
+
+class AutoJoinQueue:
+    """
+    In-process queue of pending guild joins, processed by `workers` background tasks.
+
+    Jobs are persisted in the `auto_join_jobs` table until they're done (or given up on),
+    so the ones which didn't get processed before a restart are picked up on next start.
+    """
+
+    def __init__(self, workers: int, max_attempts: int) -> None:
+        self.workers = workers
+        self.max_attempts = max_attempts
+
+        # Discord rate limits are shared by all workers, none of them should make requests before this
+        self._resume_at = 0.0
+        self._client: Optional[httpx.AsyncClient] = None
+        # Made in `start`, jobs can only be queued once the workers are running
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+
+    async def start(self, client: httpx.AsyncClient) -> None:
+        """Load the pending jobs and start processing them with `client`."""
+        self._client = client
+        self._queue = asyncio.Queue()
+
+        async with constants.DB_POOL.acquire() as db_conn:
+            pending = await database.fetch_auto_join_jobs(db_conn)
+        for user_id, access_token in pending:
+            self._queue.put_nowait(AutoJoinJob(user_id, access_token))
+        if pending:
+            logger.info(f"Resuming {len(pending)} pending auto-join jobs")
+
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Stop the workers, the unfinished jobs stay stored for the next start."""
+        for worker_task in self._worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    async def enqueue(self, db_conn: asyncpg.Connection, user_id: int, access_token: str) -> None:
+        """Store a new job and queue it, this doesn't wait for the job to be processed."""
+        if self._queue is None:
+            raise RuntimeError("AutoJoinQueue wasn't started.")
+
+        await database.store_auto_join_job(db_conn, user_id, access_token)
+        self._queue.put_nowait(AutoJoinJob(user_id, access_token))
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()  # type: ignore - this is set in `start`
+            try:
+                await self._process(job)
+            except Exception:
+                logger.exception(f"Unexpected error while auto-joining user {job.user_id}")
+            finally:
+                self._queue.task_done()  # type: ignore - this is set in `start`
+
+    async def _process(self, job: AutoJoinJob) -> None:
+        """Try to make the guild join request, retrying up to `max_attempts` times on recoverable errors."""
+        for attempt in range(1, self.max_attempts + 1):
+            wait_time = self._resume_at - time.monotonic()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+
+            try:
+                res = await self._client.put(  # type: ignore - this is set in `start`
+                    f"{constants.DISCORD_BASE_URL}/guilds/{constants.discord_guild_id}/members/{job.user_id}",
+                    json={"access_token": job.access_token},
+                    headers={"Authorization": f"Bot {constants.discord_bot_token}"},
+                )
+            except httpx.HTTPError as exc:
+                logger.warning(f"Auto-join request for user {job.user_id} failed (attempt {attempt}): {exc!r}")
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            self._update_rate_limit(res)
+            # 200: Success: Misc success
+            # 201: Created: user joined the server
+            # 204: No content: user already in the server
+            if res.status_code in (200, 201, 204):
+                break
+            # Rate limited or a discord issue, these are worth retrying
+            elif res.status_code == 429 or res.status_code >= 500:
+                logger.warning(f"Auto-join for user {job.user_id} got code {res.status_code} (attempt {attempt})")
+                if res.status_code >= 500:
+                    await asyncio.sleep(2 ** attempt)
+                continue
+
+            try:
+                # repr makes sure that no weird characters get printed and also allows
+                #  user to determine between response text of 'N/A' and real N/A
+                text = repr(res.text)
+            except Exception:
+                text = "N/A"
+            logger.error(f"Joining server for user failed: Code {res.status_code} text {text}")
+            break
+        else:
+            logger.error(f"Giving up on auto-joining user {job.user_id} after {self.max_attempts} attempts")
+
+        async with constants.DB_POOL.acquire() as db_conn:
+            await database.delete_auto_join_job(db_conn, job.user_id, job.access_token)
+
+    def _update_rate_limit(self, res: httpx.Response) -> None:
+        """Pause all workers if discord says we're out of requests for now."""
+        wait_time = 0.0
+        if res.status_code == 429:
+            try:
+                wait_time = float(res.json()["retry_after"])
+            except (ValueError, KeyError):
+                wait_time = float(res.headers.get("Retry-After", 1))
+        elif res.headers.get("X-RateLimit-Remaining") == "0":
+            wait_time = float(res.headers.get("X-RateLimit-Reset-After", 1))
+
+        if wait_time > 0:
+            self._resume_at = max(self._resume_at, time.monotonic() + wait_time)
+
+
+auto_join_queue = AutoJoinQueue(constants.auto_join_workers, constants.auto_join_max_attempts)
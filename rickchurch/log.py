@@ -1,8 +1,24 @@
+import copy
+import json
 import logging
+import logging.handlers
+import queue
 import sys
+import time
+from contextvars import ContextVar
+from typing import Dict, Hashable, List, Optional
 
 import colorama
 
+# Set for every request by the middleware, attached to every record logged while handling it
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+user_id_var: ContextVar[Optional[int]] = ContextVar("user_id", default=None)
+
+# Logger for messages which can be logged on every request (failed auths, 409s, ...), these are rate limited
+hot_path_logger = logging.getLogger("rickchurch.hotpath")
+
+_listeners: List[logging.handlers.QueueListener] = []
+
 
 class ColoredFormatter(logging.Formatter):
     COLORS = {
@@ -26,15 +42,133 @@ class ColoredFormatter(logging.Formatter):
         return super().format(record)
 
 
-def setup_logging(log_level: str):
-    log_format = ColoredFormatter(
-        f"{colorama.Fore.GREEN}%(asctime)s {colorama.Fore.RESET} | "
-        f"{colorama.Style.BRIGHT} %(name)s {colorama.Style.RESET_ALL}   | "
-        "%(levelname)s  | %(message)s"
-    )
+class JSONFormatter(logging.Formatter):
+    """Format records as single line JSON objects, including the request context."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "user_id": getattr(record, "user_id", None),
+        }
+        # Records from the queue only have the formatted traceback left, see `TracebackQueueHandler`
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry)
+
+
+class TracebackQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which keeps the traceback of a record apart from its message.
+
+    The default one formats the whole record into its message, so the formatters
+    of the listener couldn't tell the traceback apart (e.g. to put it into its own field).
+    """
+
+    _traceback_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # Merge the arguments into the message, they might not be safe to use from another thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # The traceback keeps all of its frames alive, only its text is needed
+            record.exc_text = self._traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class ContextFilter(logging.Filter):
+    """
+    Attach the request and user id to the record.
+
+    This has to run in the thread which logged the record, the context
+    variables aren't available from the queue listener's thread.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most `rate` records with the same message template through every `per` seconds.
+
+    The amount of suppressed records is added to the first record let through in the next window.
+    """
+
+    def __init__(self, rate: int, per: float = 1.0) -> None:
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        # (message template, level) -> [window start, records let through, records suppressed]
+        self._windows: Dict[Hashable, List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.msg, record.levelno)
+        now = time.monotonic()
+        window = self._windows.get(key)
+
+        if window is None or now - window[0] >= self.per:
+            if window is not None and window[2] > 0:
+                record.msg = f"{record.msg} ({window[2]} similar messages suppressed)"
+            self._windows[key] = [now, 1, 0]
+            return True
+
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
+
+
+def make_queue_handler(*handlers: logging.Handler) -> logging.handlers.QueueHandler:
+    """
+    Make a handler which hands its records over to a queue, emptied by `handlers`
+    from a separate thread, so logging through it never blocks the event loop.
+    """
+    # Unbounded, putting records into it never waits
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)  # type: ignore
+    listener.start()
+    _listeners.append(listener)
+
+    queue_handler = TracebackQueueHandler(log_queue)  # type: ignore - SimpleQueue is supported
+    queue_handler.addFilter(ContextFilter())
+    return queue_handler
+
+
+def setup_logging(log_level: str, log_format: str = "color", hot_path_rate: int = 10):
+    """Log everything from the "rickchurch" logger to stdout, through a queue handler."""
+    formatter: logging.Formatter
+    if log_format == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = ColoredFormatter(
+            f"{colorama.Fore.GREEN}%(asctime)s {colorama.Fore.RESET} | "
+            f"{colorama.Style.BRIGHT} %(name)s {colorama.Style.RESET_ALL}   | "
+            "%(levelname)s  | %(message)s"
+        )
     stream_handler = logging.StreamHandler(stream=sys.stdout)
-    stream_handler.setFormatter(log_format)
+    stream_handler.setFormatter(formatter)
 
     logger = logging.getLogger("rickchurch")
     logger.setLevel(getattr(logging, log_level))
-    logger.addHandler(stream_handler)
+    logger.addHandler(make_queue_handler(stream_handler))
+
+    hot_path_logger.addFilter(RateLimitFilter(hot_path_rate))
+
+
+def stop_logging() -> None:
+    """Write out all of the queued records and stop the listener threads."""
+    while _listeners:
+        _listeners.pop().stop()
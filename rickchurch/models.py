@@ -2,6 +2,7 @@ import base64
 import binascii
 import re
 from io import BytesIO
+from typing import Dict, List
 
 import PIL
 import PIL.Image
@@ -78,7 +79,71 @@ class User(pydantic.BaseModel):
             raise ValueError("user_id must fit within a 64 bit int.")
 
 
+class BulkModerationResult(pydantic.BaseModel):
+    """Outcome of a moderation action applied to multiple users."""
+
+    updated: List[int]
+    unchanged: List[int]
+    not_found: List[int]
+
+
+class TaskLease(pydantic.BaseModel):
+    """How long does the task stay assigned to the user."""
+
+    expires_in: float
+
+
+class LeaseStats(pydantic.BaseModel):
+    """Task lease counters since the API was started."""
+
+    assigned: int
+    renewed: int
+    expired: int
+    submitted: int
+    late_submits: int
+    active: int
+    tracked_users: int
+    mean_lease: float
+
+
+class AdmissionStats(pydantic.BaseModel):
+    """Admission control counters since the API was started."""
+
+    rejected: Dict[str, int]
+    verifications_running: int
+    tracked_users: Dict[str, int]
+
+
+class CanvasHistoryStats(pydantic.BaseModel):
+    """Canvas history usage and griefing counters since the API was started."""
+
+    frames: int
+    size_bytes: int
+    covered_seconds: float
+    instant_verifications: int
+    reverts: int
+    watched_pixels: int
+    griefed_pixels: int
+
+
 class Message(pydantic.BaseModel):
     """An API response message."""
 
     message: str
+
+
+class ProjectProgress(pydantic.BaseModel):
+    """Completion state of a project, as of the last tasks refresh."""
+
+    name: str
+    total_pixels: int
+    complete_pixels: int
+    percentage: float
+
+
+class LeaderboardEntry(pydantic.BaseModel):
+    """A single contributor in the leaderboard."""
+
+    user_id: int
+    user_name: str
+    tasks_complete: int
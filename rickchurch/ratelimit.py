@@ -0,0 +1,105 @@
+import math
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+import fastapi
+
+from rickchurch import constants
+
+
+class TokenBucket:
+    """Amount of requests a user can still make right away, as of `updated_at` (from `time.monotonic`)."""
+
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float) -> None:
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+    """Per-user token buckets, holding up to `burst` requests and refilling at `rate` requests per second."""
+
+    # How often should we forget the buckets which refilled completely (seconds)
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._pruned_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, user_id: int) -> float:
+        """Take a token from the bucket of `user_id`, return 0 on success, or how long to wait for one (seconds)."""
+        now = time.monotonic()
+        if now - self._pruned_at > self.PRUNE_INTERVAL:
+            self._prune(now)
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            self._buckets[user_id] = TokenBucket(self.burst - 1, now)
+            return 0
+
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+        bucket.updated_at = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0
+        return (1 - bucket.tokens) / self.rate
+
+    def _prune(self, now: float) -> None:
+        """Forget the buckets which are full by now, they're the same as new ones."""
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items()
+            if bucket.tokens + (now - bucket.updated_at) * self.rate < self.burst
+        }
+        self._pruned_at = now
+
+
+# (method, path) -> limiter, these are checked before the request touches the database
+route_limiters: Dict[Tuple[str, str], RateLimiter] = {
+    ("GET", "/task"): RateLimiter(constants.task_get_rate, constants.task_get_burst),
+    ("POST", "/task"): RateLimiter(constants.task_post_rate, constants.task_post_burst),
+    ("POST", "/task/renew"): RateLimiter(constants.task_post_rate, constants.task_post_burst),
+}
+# "METHOD /path" or "verification" -> amount of rejected requests
+rejected: Counter = Counter()
+verifications_running = 0
+
+
+def admit(method: str, path: str, user_id: int) -> Optional[int]:
+    """Check whether `user_id` can make this request, return `None` if so, or the Retry-After seconds otherwise."""
+    limiter = route_limiters.get((method, path))
+    if limiter is None:
+        return None
+
+    wait_time = limiter.acquire(user_id)
+    if wait_time == 0:
+        return None
+    rejected[f"{method} {path}"] += 1
+    return math.ceil(wait_time)
+
+
+@contextmanager
+def verification_slot() -> Iterator[None]:
+    """Hold one of the globally limited verification slots, raise 429 if there are none free."""
+    global verifications_running
+
+    if verifications_running >= constants.max_concurrent_verifications:
+        rejected["verification"] += 1
+        raise fastapi.HTTPException(
+            status_code=429,
+            detail="Too many submissions are being verified right now, try again later.",
+            headers={"Retry-After": "1"},
+        )
+
+    verifications_running += 1
+    try:
+        yield
+    finally:
+        verifications_running -= 1
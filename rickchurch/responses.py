@@ -0,0 +1,55 @@
+import json
+from functools import lru_cache
+from typing import Any, Iterable
+
+import fastapi
+import pydantic
+
+from rickchurch.models import Task
+
+
+class EncodedJSONResponse(fastapi.Response):
+    """
+    A response with an already encoded JSON body.
+
+    Endpoints returning these skip FastAPI's `response_model` validation and encoding,
+    the content was validated when its models were made, so it's only encoded here.
+    """
+
+    media_type = "application/json"
+
+
+def encode(content: Any) -> bytes:
+    """Encode `content` the same way FastAPI's `JSONResponse` does."""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def model_response(model: pydantic.BaseModel) -> EncodedJSONResponse:
+    return EncodedJSONResponse(encode(model.dict()))
+
+
+def models_response(models: Iterable[pydantic.BaseModel]) -> EncodedJSONResponse:
+    return EncodedJSONResponse(encode([model.dict() for model in models]))
+
+
+def message_response(text: str) -> EncodedJSONResponse:
+    return EncodedJSONResponse(encode({"message": text}))
+
+
+# Bodies of the `Message` responses which never change, the responses themselves
+# can't be shared, since their headers get modified by the middleware
+TASK_SUBMITTED = encode({"message": "Task submitted successfully."})
+MOD_CHECK = encode({"message": "You are a moderator!"})
+
+
+@lru_cache(maxsize=1024)
+def _encode_project_name(project_name: str) -> bytes:
+    return encode(project_name)
+
+
+def task_response(task: Task) -> EncodedJSONResponse:
+    """Encode a `Task` in one step, the fields are already known to be valid, with `rgb` only holding hex digits."""
+    body = b'{"x":%d,"y":%d,"rgb":"%s","project_name":%s}' % (
+        task.x, task.y, task.rgb.encode(), _encode_project_name(task.project_name)
+    )
+    return EncodedJSONResponse(body)
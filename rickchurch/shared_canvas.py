@@ -0,0 +1,220 @@
+import fcntl
+import logging
+import os
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import IO, Optional
+
+import pydispix
+
+from rickchurch import constants
+
+logger = logging.getLogger("rickchurch")
+
+# Sequence number, canvas width, canvas height, unix time the canvas was fetched at.
+# The raw RGB canvas data follows right after the header.
+_HEADER = struct.Struct("<QIId")
+_SEQUENCE = struct.Struct("<Q")
+# Sequence number and canvas size, the part of the header which is checked on every read
+_SIZED_SEQUENCE = struct.Struct("<QII")
+# Writes take microseconds, a sequence number which stays odd for this many reads belongs to a leader
+# which died in the middle of a write, this is only resolved once the next leader publishes a snapshot
+_MAX_READ_RETRIES = 10_000
+# Another process can create the segment right before sizing it, how long to wait for it to get sized (seconds)
+_OPEN_TIMEOUT = 1
+_OPEN_RETRY_DELAY = 0.01
+
+
+class StaleCanvasError(Exception):
+    """The shared canvas got resized since the view was made, its pixels aren't where the view expects them."""
+
+
+class SharedCanvas:
+    """
+    The latest canvas, shared between all worker processes through shared memory.
+
+    Only one process (the leader, holding an exclusive lock on `lock_path`) fetches the
+    canvas and publishes it here, all of the other processes read it from here. If the
+    leader dies, the OS releases its lock and the next process to try takes over.
+
+    The sequence number in the header works as a seqlock, it's odd while the leader is
+    writing and readers retry if it changed while they were reading.
+    """
+
+    def __init__(self, name: str, size: int, lock_path: str) -> None:
+        self.name = name
+        self.size = size
+        self.lock_path = lock_path
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._lock_file: Optional[IO] = None
+        self.attached_at = float("-inf")  # Unix timestamp
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lock_file is not None
+
+    def _open(self) -> shared_memory.SharedMemory:
+        deadline = time.monotonic() + _OPEN_TIMEOUT
+        while True:
+            try:
+                shm = shared_memory.SharedMemory(self.name, create=True, size=_HEADER.size + self.size)
+                break
+            except FileExistsError:
+                pass
+
+            try:
+                shm = shared_memory.SharedMemory(self.name)
+                if shm.size >= _HEADER.size:
+                    break
+                resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore - private attribute
+                shm.close()
+            except (ValueError, FileNotFoundError):
+                # The segment is still empty and can't be mapped, or it was unlinked since
+                pass
+
+            # Another process created the segment, but it didn't size it yet
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Shared canvas segment {self.name!r} wasn't sized in time")
+            # This only happens while the processes are starting, blocking for a moment is fine
+            time.sleep(_OPEN_RETRY_DELAY)
+
+        # The resource tracker would remove the segment once this process exits, even if
+        # other processes are still using it, the segment is kept and reused by name instead
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore - private attribute
+        return shm
+
+    def attach(self) -> None:
+        """
+        Create the shared memory segment, or attach to it if another process already created it.
+
+        This can be called again to attach to a segment which replaced the current one, the
+        current one isn't closed, it stays open until all of the views of it are gone.
+        """
+        self._shm = self._open()
+        self.attached_at = time.time()
+
+    def close(self) -> None:
+        """Detach from the shared memory and give up the leadership, if we had it."""
+        self.resign()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def try_lead(self) -> bool:
+        """Try to become the leader, return whether we are the leader now."""
+        if self._lock_file is not None:
+            return True
+
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self._lock_file = lock_file
+        logger.info(f"Process {os.getpid()} is now the canvas leader")
+
+        if self._shm is not None and self._shm.size < _HEADER.size + self.size:
+            # Left over from a run with a smaller size, only the leader replaces it, so there's no race
+            # between multiple processes doing so, followers attached to the old one will re-attach once it goes stale
+            logger.warning(f"Shared canvas segment is too small ({self._shm.size} bytes), replacing it")
+            # `unlink` unregisters the segment from the resource tracker, which `_open` already did
+            resource_tracker.register(self._shm._name, "shared_memory")  # type: ignore - private attribute
+            self._shm.unlink()
+            self.attach()
+        return True
+
+    def resign(self) -> None:
+        """Give up the leadership, so that another process can take over."""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            logger.info(f"Process {os.getpid()} is no longer the canvas leader")
+
+    def publish(self, canvas: pydispix.Canvas, update_time: float) -> None:
+        """Write a new canvas snapshot, only the leader should call this."""
+        raw = canvas.raw
+        buf = self._shm.buf  # type: ignore - this is set in `attach`
+        # The segment can be bigger than requested (rounded up to whole pages), but never smaller
+        if len(raw) > len(buf) - _HEADER.size:
+            logger.error(f"Canvas ({len(raw)} bytes) doesn't fit into the shared memory ({len(buf)} bytes)")
+            return
+        sequence = _SEQUENCE.unpack_from(buf)[0]
+        # Previous leader could've died in the middle of a write
+        sequence += sequence % 2
+        # Odd sequence number marks the write in progress
+        _SEQUENCE.pack_into(buf, 0, sequence + 1)
+        buf[_HEADER.size:_HEADER.size + len(raw)] = raw
+        _HEADER.pack_into(buf, 0, sequence + 2, canvas.width, canvas.height, update_time)
+
+    def snapshot(self) -> Optional["SharedCanvasView"]:
+        """Get a view of the latest published canvas, or `None` if nothing was published yet."""
+        buf = self._shm.buf  # type: ignore - this is set in `attach`
+        for _ in range(_MAX_READ_RETRIES):
+            sequence, width, height, update_time = _HEADER.unpack_from(buf)
+            if sequence == 0:
+                return None
+            if sequence % 2 == 0 and _SEQUENCE.unpack_from(buf)[0] == sequence:
+                return SharedCanvasView(self._shm, sequence, width, height, update_time)  # type: ignore
+        return None
+
+
+class SharedCanvasView:
+    """
+    A canvas read directly from the shared memory, without copying it.
+
+    Pixels always come from the latest snapshot, which may be newer than the one this view
+    was made from (`sequence`, `update_time`), but never older. If the latest snapshot has
+    a different size, the view is stale and reading from it raises `StaleCanvasError`.
+    """
+
+    def __init__(
+        self, shm: shared_memory.SharedMemory, sequence: int, width: int, height: int, update_time: float
+    ) -> None:
+        # Keeps the segment open, even if the shared canvas attached to a new one since
+        self._shm = shm
+        self._buf = shm.buf
+        self.sequence = sequence
+        self.width = width
+        self.height = height
+        self.update_time = update_time
+
+    @property
+    def raw(self) -> bytes:
+        """Copy of the whole canvas data, like `pydispix.Canvas.raw`."""
+        end = _HEADER.size + self.width * self.height * 3
+        for _ in range(_MAX_READ_RETRIES):
+            sequence, width, height = _SIZED_SEQUENCE.unpack_from(self._buf)
+            data = bytes(self._buf[_HEADER.size:end])
+            if sequence % 2 == 0 and _SEQUENCE.unpack_from(self._buf)[0] == sequence:
+                break
+        self._check_size(width, height)
+        return data
+
+    def __getitem__(self, xy) -> pydispix.Pixel:
+        x, y = xy
+        offset = _HEADER.size + (y * self.width + x) * 3
+        for _ in range(_MAX_READ_RETRIES):
+            sequence, width, height = _SIZED_SEQUENCE.unpack_from(self._buf)
+            red, green, blue = self._buf[offset:offset + 3]
+            # Retry if the leader was writing while we read the pixel
+            if sequence % 2 == 0 and _SEQUENCE.unpack_from(self._buf)[0] == sequence:
+                break
+        self._check_size(width, height)
+        return pydispix.Pixel(red, green, blue)
+
+    def _check_size(self, width: int, height: int) -> None:
+        """Raise `StaleCanvasError` if the snapshot we've read from has a different size than this view."""
+        if (width, height) != (self.width, self.height):
+            raise StaleCanvasError(f"Shared canvas got resized from {self.width}x{self.height} to {width}x{height}")
+
+
+shared_canvas: Optional[SharedCanvas] = None
+if constants.shared_canvas:
+    shared_canvas = SharedCanvas(
+        constants.shared_canvas_name,
+        constants.shared_canvas_size,
+        constants.shared_canvas_lock,
+    )
@@ -0,0 +1,77 @@
+import heapq
+from operator import itemgetter
+from typing import Dict, Hashable, Optional, Tuple
+
+import asyncpg
+import fastapi
+
+from rickchurch import constants, database, tasks
+from rickchurch.contributions import recorder
+from rickchurch.models import LeaderboardEntry, ProjectProgress
+from rickchurch.responses import EncodedJSONResponse, encode
+
+# Encoded response bodies, together with the `tasks.refresh_version` they were made in.
+# Nothing here changes in between refreshes, so polling these is just a dict lookup.
+_response_cache: Dict[Hashable, Tuple[int, bytes]] = {}
+_user_names: Dict[int, str] = {}
+
+
+def _get_cached(key: Hashable) -> Optional[fastapi.Response]:
+    """Get the response cached under `key`, unless the tasks got refreshed since it was made."""
+    entry = _response_cache.get(key)
+    if entry is None or entry[0] != tasks.refresh_version:
+        return None
+    return EncodedJSONResponse(entry[1])
+
+
+def _set_cached(key: Hashable, content: object) -> fastapi.Response:
+    """Encode `content` and cache it for the current refresh version."""
+    body = encode(content)
+    _response_cache[key] = (tasks.refresh_version, body)
+    return EncodedJSONResponse(body)
+
+
+def project_progress(project_name: str) -> fastapi.Response:
+    """Get the completion state of `project_name`, raise 404 if it isn't a tracked project."""
+    key = ("progress", project_name)
+    response = _get_cached(key)
+    if response is not None:
+        return response
+
+    try:
+        total, mismatched = tasks.project_progress[project_name]
+    except KeyError:
+        raise fastapi.HTTPException(status_code=404, detail=f"Project {project_name} doesn't exist.")
+
+    complete = total - mismatched
+    progress = ProjectProgress(
+        name=project_name,
+        total_pixels=total,
+        complete_pixels=complete,
+        percentage=round(complete / total * 100, 2) if total else 100.0,
+    )
+    return _set_cached(key, progress.dict())
+
+
+async def leaderboard(db_conn: asyncpg.Connection) -> fastapi.Response:
+    """Get the top contributors by the amount of completed tasks."""
+    response = _get_cached("leaderboard")
+    if response is not None:
+        return response
+
+    top = heapq.nlargest(constants.leaderboard_size, recorder.totals.items(), key=itemgetter(1))
+
+    # Names only need to be fetched once for every user that makes it to the top
+    missing = [user_id for user_id, _ in top if user_id not in _user_names]
+    if missing:
+        _user_names.update(await database.fetch_user_names(db_conn, missing))
+
+    entries = [
+        LeaderboardEntry(
+            user_id=user_id,
+            user_name=_user_names.get(user_id, "Unknown"),
+            tasks_complete=tasks_complete,
+        ).dict()
+        for user_id, tasks_complete in top
+    ]
+    return _set_cached("leaderboard", entries)
@@ -1,25 +1,182 @@
 import asyncio
+import itertools
 import logging
 import random
 import time
-from typing import Dict, List, Optional, Tuple
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Union
 
+import PIL.Image
+import PIL.ImageChops
 import fastapi
 import pydispix
 
-from rickchurch import constants
+from rickchurch import constants, database, tracing
+from rickchurch.contributions import recorder
+from rickchurch.history import canvas_history
 from rickchurch.models import ProjectDetails, Task
-from rickchurch.utils import deserialize_image, postpone, to_coro
+from rickchurch.ratelimit import verification_slot
+from rickchurch.shared_canvas import SharedCanvasView, StaleCanvasError, shared_canvas
+from rickchurch.utils import deserialize_image
 
 logger = logging.getLogger("rickchurch")
 
 # Use global variables to keep track of current task list,
 # this isn't ideal, but it's the easiest solution we can use.
 tasks: Dict[int, Task] = {}
-free_tasks: List[Task] = []
 projects: List[ProjectDetails] = []
-canvas: Optional[pydispix.Canvas] = None
-update_time = float("-inf")  # Unix last update timestamp
+canvas: Optional[Union[pydispix.Canvas, SharedCanvasView]] = None
+update_time = float("-inf")  # Unix timestamp of when the current canvas was fetched
+refresh_version = 0  # Incremented on every tasks refresh, used to invalidate cached responses
+# Project name -> (total pixels, mismatched pixels) as of the last refresh
+project_progress: Dict[str, Tuple[int, int]] = {}
+
+
+class FreePixels:
+    """
+    Mismatched pixels of a project which aren't assigned to anyone, kept as an array of pixel indices.
+
+    `Task` objects are only made for the pixels which get handed out, there can be
+    millions of free pixels, but only as many tasks as there are users working.
+    """
+
+    __slots__ = ("project_name", "width", "height", "colors", "indices", "hot")
+
+    def __init__(self, project_name: str, width: int, height: int, colors: bytes, indices: array) -> None:
+        self.project_name = project_name
+        self.width = width
+        self.height = height
+        self.colors = colors  # RGB data of the project image
+        self.indices = indices  # y * width + x of every free pixel, in no particular order
+        self.hot = array("I")  # Same as `indices`, but for the griefed pixels, these are handed out first
+
+    def __len__(self) -> int:
+        return len(self.indices) + len(self.hot)
+
+    def pixel_no(self, task: Task) -> Optional[int]:
+        """Get the index of the pixel of `task`, or `None` if it's outside of the project."""
+        if task.x >= self.width or task.y >= self.height:
+            return None
+        return task.y * self.width + task.x
+
+    def make_task(self, pixel_no: int) -> Task:
+        rgb = self.colors[pixel_no * 3:pixel_no * 3 + 3].hex()
+        return Task(x=pixel_no % self.width, y=pixel_no // self.width, rgb=rgb, project_name=self.project_name)
+
+    def pop_random(self) -> Task:
+        """Remove a random free pixel and make a task for it, griefed pixels go first."""
+        indices = self.hot if self.hot else self.indices
+        i = random.randrange(len(indices))
+        pixel_no = indices[i]
+        # Move the last pixel into the gap, the order doesn't matter
+        indices[i] = indices[-1]
+        indices.pop()
+        return self.make_task(pixel_no)
+
+    def push(self, task: Task) -> None:
+        """Mark the pixel of `task` free again."""
+        pixel_no = self.pixel_no(task)
+        if pixel_no is None:
+            return
+        if (self.project_name, pixel_no) in griefed_pixels:
+            self.hot.append(pixel_no)
+        else:
+            self.indices.append(pixel_no)
+
+
+# Project name -> its free pixels as of the last refresh
+free_pixels: Dict[str, FreePixels] = {}
+# (project name, pixel number) -> unix time its task was completed at, these are watched for reverts
+completed_pixels: Dict[Tuple[str, int], float] = {}
+# (project name, pixel number) -> (times reverted after completion, unix time of the last revert),
+# only kept for `constants.griefed_pixel_time` after the last revert
+griefed_pixels: Dict[Tuple[str, int], Tuple[int, float]] = {}
+# Counts of submissions verified from the canvas history and of completed pixels which got reverted
+history_stats: Counter = Counter()
+
+
+class Lease:
+    """Bookkeeping of a task assigned to a user, all times are from `time.monotonic`."""
+
+    __slots__ = ("task", "claimed_at", "expires_at", "renewals", "verifying", "handle")
+
+    def __init__(self, task: Task, claimed_at: float) -> None:
+        self.task = task
+        self.claimed_at = claimed_at
+        self.expires_at = claimed_at
+        self.renewals = 0
+        self.verifying = False
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+leases: Dict[int, Lease] = {}
+# Smoothed claim-to-submit latency of every user who submitted a task, used to size their leases
+user_latency: Dict[int, float] = {}
+# Last task of every user which expired before they submitted it, with the time it was claimed
+expired_leases: Dict[int, Tuple[Task, float]] = {}
+# Counts of assigned, renewed, expired and submitted leases, and of submits which came after the lease expired
+lease_stats: Counter = Counter()
+
+
+def lease_duration(user_id: int) -> float:
+    """Get the lease duration for `user_id`, based on how long do they usually take to submit a task."""
+    latency = user_latency.get(user_id)
+    if latency is None:
+        return constants.task_pending_delay
+    return min(max(latency * constants.task_lease_factor, constants.task_lease_min), constants.task_lease_max)
+
+
+def lease_time_left(user_id: int) -> float:
+    """Get the amount of seconds until the lease of the task assigned to `user_id` expires."""
+    return max(leases[user_id].expires_at - time.monotonic(), 0)
+
+
+def _record_latency(user_id: int, latency: float) -> None:
+    previous = user_latency.get(user_id)
+    if previous is None:
+        user_latency[user_id] = latency
+    else:
+        user_latency[user_id] = previous + constants.task_lease_smoothing * (latency - previous)
+
+
+def _schedule_expiry(user_id: int, lease: Lease) -> None:
+    """(Re)start the lease of `user_id`, it expires after `lease_duration` from now."""
+    if lease.handle is not None:
+        lease.handle.cancel()
+    duration = lease_duration(user_id)
+    lease.expires_at = time.monotonic() + duration
+    lease.handle = asyncio.get_event_loop().call_later(duration, _expire_lease, user_id)
+
+
+def _expire_lease(user_id: int) -> None:
+    lease = leases[user_id]
+    expired_leases[user_id] = (lease.task, lease.claimed_at)
+    lease_stats["expired"] += 1
+    unassign_task(user_id)
+
+
+def _drop_lease(user_id: int) -> Task:
+    """Remove the task assigned to `user_id` together with its lease, return the task."""
+    lease = leases.pop(user_id)
+    if lease.handle is not None:
+        lease.handle.cancel()
+    return tasks.pop(user_id)
+
+
+def renew_lease(user_id: int) -> float:
+    """Restart the lease of the task assigned to `user_id`, return its new duration, raise 409 on fail."""
+    lease = leases.get(user_id)
+    if lease is None:
+        raise fastapi.HTTPException(status_code=409, detail="You don't have a task assigned.")
+    if lease.renewals >= constants.task_max_renewals:
+        raise fastapi.HTTPException(status_code=409, detail="This lease can't be renewed anymore.")
+
+    lease.renewals += 1
+    lease_stats["renewed"] += 1
+    if not lease.verifying:
+        _schedule_expiry(user_id, lease)
+    return lease_duration(user_id)
 
 
 async def submit_task(task: Task, user_id: int) -> None:
@@ -27,37 +184,90 @@ async def submit_task(task: Task, user_id: int) -> None:
     global tasks
 
     submit_time = time.time()
+    # The user's latency ends here, verifying the submission can take up to a whole canvas refresh
+    submitted_at = time.monotonic()
 
     if tasks.get(user_id) != task:
+        expired_task, claimed_at = expired_leases.get(user_id, (None, 0))
+        if expired_task == task:
+            # The lease was too short for this user, make sure their next one is longer
+            lease_stats["late_submits"] += 1
+            _record_latency(user_id, submitted_at - claimed_at)
+            del expired_leases[user_id]
         raise fastapi.HTTPException(
             status_code=409,
             detail="This task doesn't belong to you, "
                    "it has likely been reassigned since you took too long to complete it."
         )
 
-    pixel = await get_fastest_pixel(task.x, task.y, submit_time)
-    pixel_color = pydispix.parse_color(pixel)
-    if pixel_color != task.rgb:
-        raise fastapi.HTTPException(
-            status_code=409,
-            detail="Validation error, you didn't actually complete this task"
-        )
-
-    del tasks[user_id]
-
-
-async def get_fastest_pixel(x: int, y: int, submit_time: float) -> pydispix.Pixel:
+    lease = leases[user_id]
+    if lease.verifying:
+        raise fastapi.HTTPException(status_code=409, detail="This task is already being verified.")
+
+    with verification_slot():
+        # Don't let the lease expire while we're verifying the submission
+        lease.verifying = True
+        if lease.handle is not None:
+            lease.handle.cancel()
+
+        submitted = False
+        try:
+            with tracing.span("verify"):
+                claim_time = submit_time - (submitted_at - lease.claimed_at)
+                color = tuple(bytes.fromhex(task.rgb))
+                pixel = await get_fastest_pixel(task.x, task.y, submit_time, claim_time, color)  # type: ignore
+
+            # The task could've been removed during verification, if its project was removed
+            if leases.get(user_id) is not lease:
+                raise fastapi.HTTPException(status_code=409, detail="This task is no longer tracked.")
+
+            pixel_color = pydispix.parse_color(pixel)
+            if pixel_color != task.rgb:
+                raise fastapi.HTTPException(
+                    status_code=409,
+                    detail="Validation error, you didn't actually complete this task"
+                )
+
+            _record_latency(user_id, submitted_at - lease.claimed_at)
+            lease_stats["submitted"] += 1
+            _drop_lease(user_id)
+            submitted = True
+        finally:
+            lease.verifying = False
+            # Restart the lease whenever the task is still assigned, this also covers verifications
+            # which failed (e.g. on a pixels API error) or got cancelled (e.g. on a client disconnect)
+            if not submitted and leases.get(user_id) is lease:
+                _schedule_expiry(user_id, lease)
+
+    recorder.record(task, user_id)
+
+    pool = free_pixels.get(task.project_name)
+    if pool is not None:
+        completed_pixels[task.project_name, task.y * pool.width + task.x] = time.time()
+
+
+async def get_fastest_pixel(
+    x: int, y: int, submit_time: float, claim_time: float, color: Tuple[int, int, int]
+) -> pydispix.Pixel:
     """
     Get pixel at `x, y` in the fastest possible way.
-    This pixel needs to have been fetched after `submit_time`.
+    This pixel needs to have been fetched after `submit_time`, unless it's already
+    in the expected `color` in a canvas fetched after the task was claimed (`claim_time`).
 
+    - If the pixel is in `color` in any canvas fetched since `claim_time`, return it from the canvas history.
     - If the canvas already got updated, simply return the pixel from it.
     - If the wait time on `get_pixel` would be lower than the wait time to
     re-update the canvas, use `get_pixel` endpoint instead.
-    - If both of the above are false, wait out the time limit to canvas update.
+    - If none of the above are true, wait out the time limit to canvas update.
     """
+    with tracing.span("history.lookup"):
+        completed_at = canvas_history.matched_since(x, y, color, claim_time)
+    if completed_at is not None:
+        history_stats["instant_verifications"] += 1
+        return pydispix.Pixel(*color)
+
     if update_time >= submit_time:
-        return canvas[x, y]  # type: ignore - canvas won't be None here
+        return await _canvas_pixel(x, y)
     else:
         # We haven't yet updated the canvas
         expected_update_time = constants.task_refresh_time + update_time
@@ -66,53 +276,77 @@ async def get_fastest_pixel(x: int, y: int, submit_time: float) -> pydispix.Pixe
 
         # Check if expected time for use get_pixel endpoint wouldn't be lower
         url = constants.PYDISPIX_CLIENT.resolve_endpoint("/get_pixel")
-        await constants.PYDISPIX_CLIENT.make_raw_request(
-            "HEAD", url,
-            headers=constants.PYDISPIX_CLIENT.headers,
-            update_rate_limits=True
-        )
+        with tracing.span("pixels.head"):
+            await constants.PYDISPIX_CLIENT.make_raw_request(
+                "HEAD", url,
+                headers=constants.PYDISPIX_CLIENT.headers,
+                update_rate_limits=True
+            )
         wait_time = constants.PYDISPIX_CLIENT.rate_limiter.rate_limits[url].get_wait_time()
         expected_get_pixel_time = wait_time + time.time()
 
         if expected_update_time > expected_get_pixel_time:
             # Using get_pixel will be faster than waiting for canvas update
-            return await constants.PYDISPIX_CLIENT.get_pixel(x, y)
+            with tracing.span("pixels.get_pixel"):
+                return await constants.PYDISPIX_CLIENT.get_pixel(x, y)
 
     # Waiting for get_pixel would take longer, wait out the canvas update
     wait_time = expected_update_time - time.time()
-    await asyncio.sleep(wait_time)
-    return canvas[x, y]  # type: ignore - canvas won't be None here
+    with tracing.span("canvas.wait"):
+        await asyncio.sleep(wait_time)
+    return await _canvas_pixel(x, y)
+
+
+async def _canvas_pixel(x: int, y: int) -> pydispix.Pixel:
+    """Get pixel at `x, y` from the current canvas, or from the API if the shared canvas got resized since."""
+    try:
+        return canvas[x, y]  # type: ignore - canvas won't be None here
+    except StaleCanvasError:
+        with tracing.span("pixels.get_pixel"):
+            return await constants.PYDISPIX_CLIENT.get_pixel(x, y)
 
 
 async def assign_free_task(user_id: int) -> Task:
     """Assign a free task to `user_id`, raise 409 on fail"""
     global tasks
-    global free_tasks
 
     if user_id in tasks:
         raise fastapi.HTTPException(status_code=409, detail="You already have a task assigned.")
-    if len(free_tasks) == 0:
+
+    # Griefed pixels go first, otherwise every free pixel has the same chance of being picked, regardless of its project
+    pools = [pool for pool in free_pixels.values() if pool.hot]
+    weights = [len(pool.hot) for pool in pools]
+    if len(pools) == 0:
+        pools = [pool for pool in free_pixels.values() if len(pool) > 0]
+        weights = [len(pool) for pool in pools]
+    if len(pools) == 0:
         raise fastapi.HTTPException(status_code=409, detail="No aviable tasks.")
 
-    task = random.choice(free_tasks)
-    free_tasks.remove(task)
+    pool, = random.choices(pools, weights=weights)
+    task = pool.pop_random()
     tasks[user_id] = task
-    asyncio.create_task(postpone(
-        constants.task_pending_delay,
-        to_coro(unassign_task, user_id),  # type: ignore
-        predicate=lambda: user_id in tasks
-    ))
+
+    lease = leases[user_id] = Lease(task, time.monotonic())
+    _schedule_expiry(user_id, lease)
+    expired_leases.pop(user_id, None)
+    lease_stats["assigned"] += 1
     return task
 
 
 def unassign_task(user_id: int) -> None:
     """Unassign given `task` from `user_id` and mark it free to be claimed"""
-    global tasks
-    global free_tasks
-
-    task = tasks[user_id]
-    del tasks[user_id]
-    free_tasks.append(task)
+    task = _drop_lease(user_id)
+    pool = free_pixels.get(task.project_name)
+    if pool is None:
+        return
+    try:
+        completed = pydispix.parse_color(canvas[task.x, task.y]) == task.rgb  # type: ignore
+    except StaleCanvasError:
+        # The free pixels get rebuilt from the resized canvas on the next refresh anyway
+        completed = False
+    # The pixel could've been completed since it was assigned
+    if not completed:
+        pool.push(task)
 
 
 async def reload_loop() -> None:
@@ -122,73 +356,148 @@ async def reload_loop() -> None:
     """
     global projects
 
-    while True:
-        async with constants.DB_POOL.acquire() as db_conn:
-            db_projects = await db_conn.fetch("SELECT * FROM projects")
-
-        local_projects = []
-        for db_project in db_projects:
-            project_model = ProjectDetails(
-                name=db_project["project_name"],
-                x=db_project["position_x"],
-                y=db_project["position_y"],
-                priority=db_project["project_priority"],
-                image=db_project["base64_image"]
-            )
-            local_projects.append(project_model)
-
-        projects = local_projects
-        await update_tasks()
-        await asyncio.sleep(constants.task_refresh_time)
-
-
-async def update_tasks() -> None:
-    global free_tasks
-    global update_time
-    global canvas
-
-    canvas = await constants.PYDISPIX_CLIENT.get_canvas()
+    try:
+        while True:
+            trace = tracing.Trace("refresh")
+            tracing.current_trace.set(trace)
 
-    local_tasks = []
-    for project in projects:
-        img = deserialize_image(project.image)
+            with tracing.span("projects.fetch"):
+                async with constants.DB_POOL.acquire() as db_conn:
+                    projects = await database.fetch_projects(db_conn)
 
-        img_rgb = img.convert("RGB")
-        w, h = img.size
+            await update_tasks()
+            if trace.finish() > constants.trace_slow_refresh:
+                trace.export()
+            await asyncio.sleep(constants.task_refresh_time)
+    finally:
+        # Nothing is going to be published from this process anymore, let another one take over
+        if shared_canvas is not None:
+            shared_canvas.resign()
 
-        random_pixels = list(range(w * h))
-        random.shuffle(random_pixels)  # this happens in-place
 
-        for pixel_no in random_pixels:
-            x = pixel_no % w
-            y = pixel_no // w
-            color: Tuple[int, int, int] = img_rgb.getpixel((x, y))  # type: ignore - this is RGB (3x int tuple)
-
-            # Check if color is already matching
-            if canvas[x, y].triple == color:  # type: ignore - canvas won't be None here
-                continue
-
-            local_tasks.append(Task(x=x, y=y, rgb=pydispix.parse_color(color), project_name=project.name))
+async def fetch_canvas() -> Optional[Tuple[Union[pydispix.Canvas, SharedCanvasView], float]]:
+    """
+    Get the current canvas together with the unix time it was fetched at.
 
-    # Set some variables for fast lookups
-    local_tasks_set = set(local_tasks)
-    free_tasks_set = set(free_tasks)
-    tasks_set = set(tasks.values())
-    rev_tasks = {value: key for key, value in tasks.items()}
-    active_tasks = free_tasks_set.union(tasks_set)
+    With a shared canvas, only the leader process fetches it from the API and publishes it,
+    the others read the published one, or get `None` if the leader didn't publish anything yet.
+    If the published canvas gets too old, the others fetch it themselves until it's fresh again.
+    """
+    if shared_canvas is not None and not shared_canvas.try_lead():
+        with tracing.span("canvas.snapshot"):
+            view = shared_canvas.snapshot()
+        if view is not None and time.time() - view.update_time <= constants.shared_canvas_max_age:
+            return view, view.update_time
+        if view is None and time.time() - shared_canvas.attached_at <= constants.shared_canvas_max_age:
+            return None
+
+        # The leader still holds the lock, but it stopped publishing, or it replaced the segment
+        logger.warning("Shared canvas is stale, fetching the canvas from the API directly")
+        shared_canvas.attach()
+
+    with tracing.span("pixels.get_canvas"):
+        new_canvas = await constants.PYDISPIX_CLIENT.get_canvas()
+    fetch_time = time.time()
+
+    if shared_canvas is not None and shared_canvas.is_leader:
+        with tracing.span("canvas.publish"):
+            shared_canvas.publish(new_canvas, fetch_time)
+    return new_canvas, fetch_time
+
+
+def _mismatch_mask(image: PIL.Image.Image, canvas_image: PIL.Image.Image) -> bytearray:
+    """Get a byte for every pixel of `image`, non-zero where it doesn't match the canvas."""
+    w, h = image.size
+    red, green, blue = PIL.ImageChops.difference(image, canvas_image.crop((0, 0, w, h))).split()
+    return bytearray(PIL.ImageChops.lighter(PIL.ImageChops.lighter(red, green), blue).tobytes())
+
+
+def _update_griefed_pixels(masks: Dict[str, bytearray], fetch_time: float) -> None:
+    """Mark the completed pixels which are mismatched again in the canvas fetched at `fetch_time` as griefed."""
+    global griefed_pixels
+
+    for key, completed_at in list(completed_pixels.items()):
+        name, pixel_no = key
+        mask = masks.get(name)
+        if mask is None or pixel_no >= len(mask):
+            del completed_pixels[key]
+        elif fetch_time <= completed_at:
+            continue
+        elif mask[pixel_no]:
+            reverts, _ = griefed_pixels.get(key, (0, 0))
+            griefed_pixels[key] = (reverts + 1, fetch_time)
+            history_stats["reverts"] += 1
+            del completed_pixels[key]
+        elif fetch_time - completed_at > constants.griefed_pixel_time:
+            # It stayed fixed for long enough, stop watching it
+            del completed_pixels[key]
 
-    # Remove tasks that aren't tracked anymore (from removed projects)
-    for task in active_tasks:
-        if task not in local_tasks_set:
-            if task in free_tasks_set:
-                free_tasks.remove(task)
-            elif task in rev_tasks:
-                key = rev_tasks[task]
-                del tasks[key]
+    griefed_pixels = {
+        key: (reverts, reverted_at) for key, (reverts, reverted_at) in griefed_pixels.items()
+        if fetch_time - reverted_at <= constants.griefed_pixel_time
+    }
 
-    for task in local_tasks:
-        if task in active_tasks:
-            continue
-        free_tasks.append(task)
 
-    update_time = time.time()
+async def update_tasks() -> None:
+    global free_pixels
+    global update_time
+    global canvas
+    global refresh_version
+    global project_progress
+
+    fetched = await fetch_canvas()
+    if fetched is None:
+        logger.debug("No shared canvas was published yet, skipping tasks update")
+        return
+    new_canvas, fetch_time = fetched
+    try:
+        raw = new_canvas.raw
+    except StaleCanvasError:
+        # The leader published a resized canvas right after we got this one, it's picked up on the next refresh
+        logger.info("Shared canvas got resized while reading it, skipping tasks update")
+        return
+    canvas = new_canvas
+
+    with tracing.span("history.append"):
+        canvas_history.append(raw, (canvas.width, canvas.height), fetch_time)
+
+    with tracing.span("tasks.build"):
+        canvas_image = PIL.Image.frombytes("RGB", (canvas.width, canvas.height), raw)
+
+        local_pixels = {}
+        local_progress = {}
+        masks = {}
+        for project in projects:
+            img_rgb = deserialize_image(project.image).convert("RGB")
+            w, h = img_rgb.size
+
+            mask = masks[project.name] = _mismatch_mask(img_rgb, canvas_image)
+            local_pixels[project.name] = FreePixels(project.name, w, h, img_rgb.tobytes(), array("I"))
+            local_progress[project.name] = (w * h, w * h - mask.count(0))
+
+        _update_griefed_pixels(masks, fetch_time)
+
+        # Remove assigned tasks that aren't tracked anymore (from removed or changed projects), the remaining ones
+        # stay assigned, so they can't be free at the same time. Pixels which already match were likely completed
+        # by the user who has them assigned, they can still submit them, since they're verified from the history.
+        for user_id, task in list(tasks.items()):
+            pool = local_pixels.get(task.project_name)
+            pixel_no = pool.pixel_no(task) if pool is not None else None
+            if pixel_no is None or pool.make_task(pixel_no) != task:
+                _drop_lease(user_id)
+            else:
+                masks[task.project_name][pixel_no] = 0
+
+        for name, pixel_no in griefed_pixels:
+            mask = masks.get(name)
+            if mask is not None and pixel_no < len(mask) and mask[pixel_no]:
+                local_pixels[name].hot.append(pixel_no)
+                mask[pixel_no] = 0
+
+        for name, pool in local_pixels.items():
+            pool.indices = array("I", itertools.compress(range(len(masks[name])), masks[name]))
+
+    free_pixels = local_pixels
+    project_progress = local_progress
+    update_time = fetch_time
+    refresh_version += 1
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional, Tuple
+
+from rickchurch.log import make_queue_handler
+
+logger = logging.getLogger("rickchurch")
+# Slow traces are written here as JSON lines, this logger doesn't propagate to the stdout handler
+trace_logger = logging.getLogger("rickchurch.traces")
+trace_logger.propagate = False
+_export_enabled = False
+
+current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+_profile_lock = threading.Lock()
+
+
+class Trace:
+    """Timings of the individual phases (spans) of a request or a tasks refresh."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.spans: List[Tuple[str, float]] = []
+
+    def finish(self) -> float:
+        """Mark the trace as finished and return its total duration (seconds)."""
+        self.duration = time.perf_counter() - self._start
+        return self.duration
+
+    def server_timing(self) -> str:
+        """Format the spans as a `Server-Timing` header value (milliseconds)."""
+        timings = [f"{name};dur={duration * 1000:.2f}" for name, duration in self.spans]
+        if self.duration is not None:
+            timings.append(f"total;dur={self.duration * 1000:.2f}")
+        return ", ".join(timings)
+
+    def export(self, **extra) -> None:
+        """Write this trace to the slow traces file, if `setup_trace_export` was called."""
+        if not _export_enabled:
+            return
+
+        entry = {
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "spans": [{"name": name, "duration": duration} for name, duration in self.spans],
+            **extra,
+        }
+        trace_logger.info(json.dumps(entry))
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time the wrapped block as `name` in the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, time.perf_counter() - start))
+
+
+def setup_trace_export(path: str, max_bytes: int, backup_count: int) -> None:
+    """
+    Make exported traces get appended to the file at `path`, through a queue handler.
+
+    The file is rotated once it reaches `max_bytes`, keeping `backup_count` old files.
+    """
+    global _export_enabled
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.addHandler(make_queue_handler(file_handler))
+    _export_enabled = True
+
+
+def _sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter:
+    """Periodically sample the stack of `thread_id` for `seconds`, count how often was each stack seen."""
+    stacks: Counter = Counter()
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+async def profile_event_loop(seconds: float, interval: float = 0.005) -> str:
+    """
+    Sample the stack of the thread running the event loop for `seconds` from another thread.
+
+    Return the sampled stacks in the collapsed format (`frame;frame;frame count` per line),
+    which can be loaded into flamegraph tools directly. Raise `RuntimeError` if a profile
+    is already running.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running.")
+
+    try:
+        loop = asyncio.get_running_loop()
+        stacks = await loop.run_in_executor(None, _sample_stacks, threading.get_ident(), seconds, interval)
+    finally:
+        _profile_lock.release()
+
+    logger.info(f"Profiled the event loop for {seconds}s ({sum(stacks.values())} samples)")
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
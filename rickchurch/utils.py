@@ -1,36 +1,25 @@
-import asyncio
 import base64
-import inspect
 import logging
 from io import BytesIO
-from typing import Callable, Coroutine, List, Tuple, Union
+from typing import Tuple
 
 import PIL.Image
-import asyncpg
 import httpx
 
 from rickchurch import constants
-from rickchurch.models import ProjectDetails
 
 logger = logging.getLogger("rickchurch")
 
 
-async def fetch_projects(db_conn: asyncpg.Connection) -> List[ProjectDetails]:
-    """Obtain list of active projects in the database"""
-    async with db_conn.transaction():
-        db_projects = await db_conn.fetch("SELECT * FROM projects")
-
-    projects = []
-    for db_project in db_projects:
-        project = ProjectDetails(
-            name=db_project["project_name"],
-            x=db_project["position_x"],
-            y=db_project["position_y"],
-            priority=db_project["project_priority"],
-            image=db_project["base64_image"],
-        )
-        projects.append(project)
-    return projects
+def make_discord_client() -> httpx.AsyncClient:
+    """Make a HTTP client for discord's API, keeping its connections alive to reuse them across requests."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=constants.discord_max_connections,
+            max_keepalive_connections=constants.discord_max_keepalive,
+        ),
+        timeout=httpx.Timeout(constants.discord_timeout, connect=5.0),
+    )
 
 
 async def get_oauth_user(httpx_client: httpx.AsyncClient, code: str) -> Tuple[dict, str]:
@@ -78,20 +67,3 @@ def serialize_image(image: PIL.Image.Image) -> str:
     f = BytesIO()
     image.save(f, format="PNG")
     return base64.b64encode(f.getvalue()).decode()
-
-
-async def postpone(seconds: Union[int, float], coro: Coroutine, predicate: Callable):
-    try:
-        await asyncio.sleep(seconds)
-        if predicate() is True:
-            # Prevent `coro` from cancelling itself by shielding it
-            await asyncio.shield(coro)
-    finally:
-        # Prevent coroutine never awaited error if it got cancelled during sleep
-        # But only do so if it wasn't awaited yet, since the coro can also cancel itself
-        if inspect.getcoroutinestate(coro) == "CORO_CREATED":
-            coro.close()
-
-
-async def to_coro(sync_func: Callable, *args, **kwargs):
-    return sync_func(*args, **kwargs)